@@ -22,7 +22,9 @@ using a masked language modeling (MLM) loss.
 
 import argparse
 import glob
+import json
 import logging
+import mmap
 import os
 import pickle
 import random
@@ -80,11 +82,42 @@ MODEL_CLASSES = {
 }
 
 
+def read_text(file_path, num_sentences=None):
+    # Read the first num_sentences lines of file_path (all of them if None) through mmap, so only they are read
+    # Files from synthetic_data's SentenceWriter have an index next to them (file_path + ".index.json") with the byte
+    # offsets where some of their prefixes end. Otherwise the end is found by looking for the line breaks
+    with open(file_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ""
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    with mapped:
+        end = len(mapped)
+        if num_sentences is not None:
+            index = None
+            if os.path.exists(file_path + ".index.json"):
+                with open(file_path + ".index.json") as f:
+                    index = json.load(f)
+            if index is not None and index["num_bytes"] == len(mapped) and str(num_sentences) in index["offsets"]:
+                end = index["offsets"][str(num_sentences)]
+            else:
+                position = -1 if num_sentences > 0 else 0
+                for _ in range(num_sentences):
+                    position = mapped.find(b"\n", position + 1)
+                    if position == -1:
+                        position = len(mapped)
+                        break
+                end = position
+        with memoryview(mapped) as view:
+            return str(view[:end], "utf-8")
+
+
 class TextDataset(Dataset):
-    def __init__(self, tokenizer, args, file_path="train", block_size=512):
+    def __init__(self, tokenizer, args, file_path="train", block_size=512, num_sentences=None):
         print(f"file_path is {file_path}")  # Added this line
         assert os.path.isfile(file_path)
         directory, filename = os.path.split(file_path)
+        if num_sentences is not None:
+            filename = f"{num_sentences}_{filename}"
         cached_features_file = os.path.join(
             directory, args.model_name_or_path + "_cached_lm_" + str(block_size) + "_" + filename
         )
@@ -97,8 +130,7 @@ class TextDataset(Dataset):
             logger.info("Creating features from dataset file at %s", directory)
 
             self.examples = []
-            with open(file_path, encoding="utf-8") as f:
-                text = f.read()
+            text = read_text(file_path, num_sentences)
 
             tokenized_text = tokenizer.convert_tokens_to_ids(tokenizer.tokenize(text))
 
@@ -128,6 +160,7 @@ def load_and_cache_examples(args, tokenizer, evaluate=False):
         args,
         file_path=args.eval_data_file if evaluate else args.train_data_file,
         block_size=args.block_size,
+        num_sentences=None if evaluate else args.train_num_sentences,
     )
     return dataset
 
@@ -447,6 +480,12 @@ def main():
     )
 
     # Other parameters
+    parser.add_argument(
+        "--train_num_sentences",
+        default=None,
+        type=int,
+        help="Only train on the first train_num_sentences sentences (lines) of the training data file.",
+    )
     parser.add_argument(
         "--eval_data_file",
         default=None,
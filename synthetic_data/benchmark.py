@@ -0,0 +1,203 @@
+import argparse
+import json
+import multiprocessing
+import platform
+import queue
+import random
+import resource
+import subprocess
+import sys
+import time
+import traceback
+
+import numpy as np
+
+import generator
+import language
+
+# Benchmark Language.generate_sentences on the languages of generator.py
+# It can be run from any folder, since generator.py finds the dictionaries from where it is:
+#   python benchmark.py --output results.json
+#   python benchmark.py --output new.json --compare results.json
+# Every case (a language and a sampling mode) runs in a process of its own, so its peak RSS is its own. The results
+#   are written as json, with the sentences per second, peak RSS, per-stage times and failures of every case
+# A case that raises an error or whose process dies is recorded with its error instead, and the benchmark exits with
+#   an error after running the other cases
+
+# The languages, and the functions that build them
+LANGUAGES = {
+    "base": generator.create_language_base,
+    "frisian": generator.create_frisian_language,
+    "occitan": generator.create_occitan_language,
+    "cebuano": generator.create_cebuano_language,
+}
+
+# The sampling modes: the sampling method, and whether words are drawn from required_words
+MODES = {
+    "zipfian": ("zipfian", False),
+    "uniform": ("uniform", False),
+    "required_words": ("uniform", True),
+}
+
+# The number of words of each part of speech in required_words
+NUM_REQUIRED_WORDS = 100
+
+
+# Build a language with the global random state seeded, so it's the same every time
+# The base language has no nouns or verbs, so some are generated for it
+def build_language(name, seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    lang = LANGUAGES[name]()
+    if name == "base":
+        lang.generate_words(num_words=NUM_REQUIRED_WORDS, part_of_speech="noun", paradigm="noun")
+        lang.generate_words(num_words=NUM_REQUIRED_WORDS, part_of_speech="verb", paradigm="verb")
+    return lang
+
+
+# The required_words of a language: the first words of its two largest parts of speech
+def build_required_words(lang):
+    parts_of_speech = sorted(lang.words, key=lambda pos: -len(lang.words[pos]))[:2]
+    return {pos: list(lang.words[pos][:NUM_REQUIRED_WORDS]) for pos in parts_of_speech}
+
+
+# How often, in seconds, the benchmark checks that the process of a case is still running while it waits for it
+POLL_SECONDS = 1
+
+
+# Run one case, in a process of its own, and put ("ok", its results) in case_queue, or ("error", the traceback) if it
+#   raises an error
+def run_case(case_queue, name, mode, num_sentences, seed, repeats):
+    try:
+        case_queue.put(("ok", measure_case(name, mode, num_sentences, seed, repeats)))
+    except Exception:
+        case_queue.put(("error", traceback.format_exc()))
+
+
+# Measure one case, and return its results
+def measure_case(name, mode, num_sentences, seed, repeats):
+    start = time.perf_counter()
+    lang = build_language(name, seed)
+    build_seconds = time.perf_counter() - start
+    sampling_method, uses_required_words = MODES[mode]
+    required_words = build_required_words(lang) if uses_required_words else None
+
+    runs = []
+    for _ in range(repeats):
+        profile = language.GenerationProfile()
+        start = time.perf_counter()
+        lang.generate_sentences(num_sentences, required_words=required_words, sampling_method=sampling_method,
+                                regenerate_exception_sentences=True, output="sentences", rng=seed, stats=profile)
+        profile_dict = profile.as_dict()
+        profile_dict["wall_seconds"] = time.perf_counter() - start
+        runs.append(profile_dict)
+
+    # The fastest run is the one reported, since the others were slowed down by something else
+    best = max(runs, key=lambda run: run["sentences_per_second"])
+    return {
+        "language": name,
+        "mode": mode,
+        "num_sentences": num_sentences,
+        "seed": seed,
+        "build_seconds": build_seconds,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "sentences_per_second": best["sentences_per_second"],
+        "all_sentences_per_second": [run["sentences_per_second"] for run in runs],
+        "best_run": best,
+    }
+
+
+# Wait for the result that run_case puts in case_queue, for as long as its process is running
+# If the process dies without one, e.g. because it was killed for using too much memory, its exit code is the error
+def wait_for_case(process, case_queue):
+    while True:
+        try:
+            return case_queue.get(timeout=POLL_SECONDS)
+        except queue.Empty:
+            if process.is_alive():
+                continue
+        # The result may have arrived after the last wait, just before the process exited
+        try:
+            return case_queue.get(timeout=POLL_SECONDS)
+        except queue.Empty:
+            return "error", f"The process exited with code {process.exitcode} without a result."
+
+
+# The commit that's benchmarked, if this is a git checkout
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Print the speed of every case next to the speed in earlier results
+# Cases that failed in either are left out
+def compare(results, baseline):
+    baseline_cases = {(case["language"], case["mode"]): case for case in baseline["cases"] if "error" not in case}
+    print(f"{'language':<10}{'mode':<16}{'before':>12}{'after':>12}{'ratio':>8}")
+    for case in results["cases"]:
+        before = baseline_cases.get((case["language"], case["mode"]))
+        if before is None or "error" in case:
+            continue
+        ratio = case["sentences_per_second"] / before["sentences_per_second"]
+        print(f"{case['language']:<10}{case['mode']:<16}{before['sentences_per_second']:>12.0f}"
+              f"{case['sentences_per_second']:>12.0f}{ratio:>8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--languages", nargs="+", default=list(LANGUAGES), choices=list(LANGUAGES))
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=list(MODES))
+    parser.add_argument("--num_sentences", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--output", default="benchmark_results.json", help="Where the json results are written")
+    parser.add_argument("--compare", default=None, help="json results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    # Processes are spawned rather than forked, so the peak RSS of a case doesn't start from this one's
+    context = multiprocessing.get_context("spawn")
+    cases = []
+    failed = []
+    for name in args.languages:
+        for mode in args.modes:
+            case_queue = context.Queue()
+            process = context.Process(target=run_case,
+                                      args=(case_queue, name, mode, args.num_sentences, args.seed, args.repeats))
+            process.start()
+            status, case = wait_for_case(process, case_queue)
+            process.join()
+            if status == "ok" and process.exitcode == 0:
+                print(f"{name} {mode}: {case['sentences_per_second']:.0f} sentences/s, "
+                      f"peak RSS {case['peak_rss_mb']:.0f} MB")
+            else:
+                if status == "ok":
+                    case = f"The process exited with code {process.exitcode}."
+                print(f"{name} {mode}: failed\n{case}", file=sys.stderr)
+                case = {"language": name, "mode": mode, "error": case}
+                failed.append(f"{name} {mode}")
+            cases.append(case)
+
+    results = {
+        "commit": current_commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cases": cases,
+    }
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as file:
+            compare(results, json.load(file))
+
+    if failed:
+        sys.exit(f"The cases {', '.join(failed)} failed.")
+
+
+if __name__ == "__main__":
+    main()
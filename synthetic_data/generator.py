@@ -1,4 +1,3 @@
-import json
 import math
 import os
 import random
@@ -9,6 +8,9 @@ import numpy as np
 
 import language
 
+# The root of the repository, which the dictionaries are found from whatever the working directory is
+REPOSITORY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
 # ===================================== FRISIAN ========================================================================
 Frisian_POS = [
     "ADP",
@@ -26,8 +28,8 @@ Frisian_POS = [
 ]
 
 
-# Generate arbitrary amounts of Frisian sentences
-def generate_frisian_data(language_name="frisian_synthetic", num_train=1e6):
+# Create the synthetic Frisian language
+def create_frisian_language():
     # Create a language
     mylang = language.Language()
 
@@ -78,9 +80,9 @@ def generate_frisian_data(language_name="frisian_synthetic", num_train=1e6):
     })
 
     # Set the dictionary and set the pronouns to nothing, I already got rid of pron and det
-    with open('../data/frisian_dict.json', 'r') as frisian_dict:
-        mylang.set_dictionary(json.load(frisian_dict))
-        # See if there's a better way to do this in the future
+    # The lexicon is only read once per process, however many languages use it
+    mylang.set_dictionary(language.load_lexicon(os.path.join(REPOSITORY_PATH, "data", "frisian_dict.json")))
+    # See if there's a better way to do this in the future
 
     # Set an inflection paradigm for pronoun
     mylang.set_inflection_paradigms([
@@ -150,6 +152,15 @@ def generate_frisian_data(language_name="frisian_synthetic", num_train=1e6):
         }]
     ])
 
+    # Return the language
+    return mylang
+
+
+# Generate arbitrary amounts of Frisian sentences
+def generate_frisian_data(language_name="frisian_synthetic", num_train=1e6):
+    # Create the language
+    mylang = create_frisian_language()
+
     # Save the language
     mylang.dump_language(os.path.join("synthetic_datasets", language_name))
 
@@ -158,24 +169,22 @@ def generate_frisian_data(language_name="frisian_synthetic", num_train=1e6):
     # num_train should be a power of 10 and that it's at least 10 sentences
     assert math.log10(num_train) % 1 == 0 and num_train >= 10
 
-    # We start by generating many sentences
-    sentences, sequences = mylang.generate_sentences(num_sentences=num_train, required_words=None,
-                                                     sampling_method="uniform", regenerate_exception_sentences=True)
-
-    # Save these now
-    for num_train_group in range(1, int(math.log10(num_train)) + 1):
-        language.save_sentences(sentences=sentences[:10 ** (num_train_group + 1)],
-                                filepath=os.path.join("synthetic_datasets",
-                                                      language_name,
-                                                      f"{10 ** (num_train_group + 1)}_train_sentences.txt"))
+    # We generate the sentences and save them as they come on a writer thread, in a single file
+    # The index of the file has where the first 10 ** (num_train_group + 1) sentences end, so each training set is a
+    #   prefix of the file (see language.open_sentences)
+    prefix_sizes = [10 ** (num_train_group + 1) for num_train_group in range(1, int(math.log10(num_train)) + 1)]
+    with language.AsyncSentenceWriter(os.path.join("synthetic_datasets", language_name, "train_sentences.txt"),
+                                      prefix_sizes=prefix_sizes) as writer:
+        for sentences in mylang.iter_sentences(num_sentences=num_train, required_words=None,
+                                               sampling_method="uniform", regenerate_exception_sentences=True):
+            writer.write(sentences)
 
 
 # ===================================== OCCITAN ========================================================================
-# Generate arbitrary amounts of Frisian sentences
-def generate_occitan_data(language_name="occitan_synthetic", num_train=1e6):
+# Create the synthetic Occitan language
+def create_occitan_language():
     # Get the dictionary:
-    with open('../scripts/occitan_dict.json', 'r') as file:
-        occitan_dict = json.load(file)
+    occitan_dict = language.load_lexicon(os.path.join(REPOSITORY_PATH, "scripts", "occitan_dict.json"))
 
     # Create a language
     mylang = language.Language()
@@ -188,7 +197,7 @@ def generate_occitan_data(language_name="occitan_synthetic", num_train=1e6):
     mylang.set_phonemes(phonemes=phonemes)
 
     # Set the parts of speech of the language
-    parts_of_speech = list(occitan_dict.keys() )
+    parts_of_speech = list(occitan_dict.parts_of_speech)
     mylang.set_parts_of_speech(parts_of_speech=parts_of_speech)
 
     # Set the generation rules
@@ -394,6 +403,15 @@ def generate_occitan_data(language_name="occitan_synthetic", num_train=1e6):
         }]
     ])
 
+    # Return the language
+    return mylang
+
+
+# Generate arbitrary amounts of Frisian sentences
+def generate_occitan_data(language_name="occitan_synthetic", num_train=1e6):
+    # Create the language
+    mylang = create_occitan_language()
+
     # Save the language
     mylang.dump_language(os.path.join("synthetic_datasets", language_name))
 
@@ -402,21 +420,20 @@ def generate_occitan_data(language_name="occitan_synthetic", num_train=1e6):
     # num_train should be a power of 10 and that it's at least 10 sentences
     assert math.log10(num_train) % 1 == 0 and num_train >= 10
 
-    # We start by generating many sentences
-    sentences, sequences = mylang.generate_sentences(num_sentences=num_train, required_words=None,
-                                                     sampling_method="uniform", regenerate_exception_sentences=True)
-
-    # Save these now
-    for num_train_group in range(1, int(math.log10(num_train)) + 1):
-        language.save_sentences(sentences=sentences[:10 ** (num_train_group + 1)],
-                                filepath=os.path.join("synthetic_datasets",
-                                                      language_name,
-                                                      f"{10 ** (num_train_group + 1)}_train_sentences.txt"))
+    # We generate the sentences and save them as they come on a writer thread, in a single file
+    # The index of the file has where the first 10 ** (num_train_group + 1) sentences end, so each training set is a
+    #   prefix of the file (see language.open_sentences)
+    prefix_sizes = [10 ** (num_train_group + 1) for num_train_group in range(1, int(math.log10(num_train)) + 1)]
+    with language.AsyncSentenceWriter(os.path.join("synthetic_datasets", language_name, "train_sentences.txt"),
+                                      prefix_sizes=prefix_sizes) as writer:
+        for sentences in mylang.iter_sentences(num_sentences=num_train, required_words=None,
+                                               sampling_method="uniform", regenerate_exception_sentences=True):
+            writer.write(sentences)
 
 
 # ===================================== YORUBA =========================================================================
-# Generate arbitrary amounts of Yoruba sentences
-def generate_cebuano_data(language_name="cebuano_synthetic", num_train=1e6):
+# Create the synthetic Cebuano language
+def create_cebuano_language():
     # Create a language
     mylang = language.Language()
 
@@ -426,11 +443,10 @@ def generate_cebuano_data(language_name="cebuano_synthetic", num_train=1e6):
     mylang.set_phonemes(phonemes=phonemes)
 
     # Get the dictionary:
-    with open('../data/cebuano_dict.json', 'r') as file:
-        cebuano_dict = json.load(file)
+    cebuano_dict = language.load_lexicon(os.path.join(REPOSITORY_PATH, "data", "cebuano_dict.json"))
 
     # Set the parts of speech of the language
-    parts_of_speech = list(cebuano_dict.keys() )
+    parts_of_speech = list(cebuano_dict.parts_of_speech)
     mylang.set_parts_of_speech(parts_of_speech=parts_of_speech)
 
     # Set the generation rules
@@ -557,6 +573,15 @@ def generate_cebuano_data(language_name="cebuano_synthetic", num_train=1e6):
         }],
     ])
 
+    # Return the language
+    return mylang
+
+
+# Generate arbitrary amounts of Yoruba sentences
+def generate_cebuano_data(language_name="cebuano_synthetic", num_train=1e6):
+    # Create the language
+    mylang = create_cebuano_language()
+
     # Save the language
     mylang.dump_language(os.path.join("synthetic_datasets", language_name))
 
@@ -565,16 +590,15 @@ def generate_cebuano_data(language_name="cebuano_synthetic", num_train=1e6):
     # num_train should be a power of 10 and that it's at least 10 sentences
     assert math.log10(num_train) % 1 == 0 and num_train >= 10
 
-    # We start by generating many sentences
-    sentences, sequences = mylang.generate_sentences(num_sentences=num_train, required_words=None,
-                                                     sampling_method="uniform", regenerate_exception_sentences=True)
-
-    # Save these now
-    for num_train_group in range(1, int(math.log10(num_train)) + 1):
-        language.save_sentences(sentences=sentences[:10 ** (num_train_group + 1)],
-                                filepath=os.path.join("synthetic_datasets",
-                                                      language_name,
-                                                      f"{10 ** (num_train_group + 1)}_train_sentences.txt"))
+    # We generate the sentences and save them as they come on a writer thread, in a single file
+    # The index of the file has where the first 10 ** (num_train_group + 1) sentences end, so each training set is a
+    #   prefix of the file (see language.open_sentences)
+    prefix_sizes = [10 ** (num_train_group + 1) for num_train_group in range(1, int(math.log10(num_train)) + 1)]
+    with language.AsyncSentenceWriter(os.path.join("synthetic_datasets", language_name, "train_sentences.txt"),
+                                      prefix_sizes=prefix_sizes) as writer:
+        for sentences in mylang.iter_sentences(num_sentences=num_train, required_words=None,
+                                               sampling_method="uniform", regenerate_exception_sentences=True):
+            writer.write(sentences)
 
 
 # =====================================GENERALLY HELPFUL METHODS========================================================
@@ -644,7 +668,7 @@ def generate_and_save_sentences(lang, language_name, num_sentences, sentence_pre
     os.makedirs(os.path.join(directory_path, "train"), exist_ok=True)
 
     # Generate some sentences
-    sentences, _ = lang.generate_sentences(num_sentences, required_words)
+    sentences, _ = lang.generate_sentences(num_sentences, required_words, output="sentences")
     rand.shuffle(sentences)
 
     # These are the sizes of the test
@@ -674,6 +698,27 @@ def generate_and_save_sentences(lang, language_name, num_sentences, sentence_pre
     return sentences
 
 
+# Generate sentences until they have num_tokens tokens, saving them as they're generated
+# The tokens are counted with the tokenizer in tokenizer_path (e.g. ../tokenizers/frisian), or as whitespace separated
+#   words if it's None, so that synthetic corpora can be matched with real ones on the tokens a model trains on
+# Returns the path of the file and the number of sentences in it
+def generate_and_save_tokens(lang, language_name, num_tokens, sentence_prefix, tokenizer_path=None,
+                             required_words=None):
+    # Create the directory if it does not exist
+    directory_path = os.path.join("Languages", language_name, "train")
+    os.makedirs(directory_path, exist_ok=True)
+
+    # Count tokens with the tokenizer if there is one
+    count_tokens = None if tokenizer_path is None else language.tokenizer_counter(tokenizer_path)
+
+    # Save every batch on a writer thread as soon as it's generated
+    filepath = os.path.join(directory_path, f"{num_tokens}_tokens_{sentence_prefix}_sentences.txt")
+    with language.AsyncSentenceWriter(filepath) as writer:
+        for sentences in lang.iter_sentences_by_tokens(num_tokens, count_tokens, required_words):
+            writer.write(sentences)
+    return filepath, writer.num_sentences
+
+
 # Creates a test language
 def create_language_base():
     # Create a language
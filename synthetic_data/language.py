@@ -1,46 +1,1391 @@
+import bz2
+import gzip
 import json
+import lzma
+import mmap
+import multiprocessing
 import os
+import pickle
+import queue
+import threading
+import numpy as np
 import numpy.random as nprand
 import random
-from copy import deepcopy
+from bisect import bisect
+from collections.abc import MutableSequence
+from math import lgamma, log
+from copy import copy
+from time import perf_counter
+from itertools import accumulate, chain, islice
 
 from tqdm import tqdm
 
+# The kinds of states in a CompiledGrammar
+_TERMINAL = 0
+_GENERATION = 1
+_UNCONDITIONED = 2
+_UNDEFINED = 3
+
+
+# An error in generating a sentence that a local retry may fix (see Language.set_retry_budget)
+# code is a short string naming the kind of error, and rule the agreement trigger, paradigm (see InflectionTable.name)
+#   or state that caused it, so errors can be counted without formatting a message (see GenerationStats). The codes are
+#   agreement_controllers: a word doesn't have exactly one word triggering its agreement
+#   agreement_feature: the word triggering agreement doesn't have exactly one property of a feature that's sought
+#   multiple_agreements: a word takes more than one agreement, with the rule being all of their triggers joined by .
+#   environment_too_long, inflection_count: a paradigm has no inflection for a word, or more than one
+#   undefined_state: the grammar has a state that isn't a terminal or a rule
+# position is the word the error is about, and phrase the innermost phrase that has to be drawn again to fix it. Both
+#   are None if they aren't known
+# describe is a function without arguments that returns the full message. It's only called if the error is printed,
+#   since most errors are thrown away when sentences are regenerated
+class GenerationError(Exception):
+    def __init__(self, code, rule, position=None, phrase=None, describe=None):
+        super().__init__(code, rule)
+        self.code = code
+        self.rule = rule
+        self.position = position
+        self.phrase = phrase
+        self.describe = describe
+
+    def __str__(self):
+        if self.describe is None:
+            return f"{self.code} ({self.rule})"
+        return self.describe()
+
+
+# Counts of what happened while generating sentences, see Language.generate_sentences
+#   sentences is the number of sentences generated, and regenerated the number thrown away because of an error
+#   failures maps (code, rule) of the errors that made sentences get thrown away to how many times they did
+#   retried maps (code, rule) of the errors that local retries drew phrases again for to how many times they did
+# Errors that aren't GenerationErrors are counted by the name of their type, with the rule None
+class GenerationStats:
+    __slots__ = ("sentences", "regenerated", "failures", "retried")
+
+    def __init__(self):
+        self.sentences = 0
+        self.regenerated = 0
+        self.failures = {}
+        self.retried = {}
+
+    # The (code, rule) key of an error
+    @staticmethod
+    def key(error):
+        if isinstance(error, GenerationError):
+            return error.code, error.rule
+        return type(error).__name__, None
+
+    # Count an error that made a sentence get thrown away
+    def record_failure(self, error):
+        key = self.key(error)
+        self.failures[key] = self.failures.get(key, 0) + 1
+        self.regenerated += 1
+
+    # Count an error that a local retry drew a phrase again for
+    def record_retry(self, error):
+        key = self.key(error)
+        self.retried[key] = self.retried.get(key, 0) + 1
+
+    # The number of local retries
+    @property
+    def retries(self):
+        return sum(self.retried.values())
+
+    # Add the counts of other, e.g. from another shard, to these
+    def update(self, other):
+        self.sentences += other.sentences
+        self.regenerated += other.regenerated
+        for counts, other_counts in ((self.failures, other.failures), (self.retried, other.retried)):
+            for key, count in other_counts.items():
+                counts[key] = counts.get(key, 0) + count
+
+    # The failures added up over the rules of each code
+    def failures_by_code(self):
+        counts = {}
+        for (code, _), count in self.failures.items():
+            counts[code] = counts.get(code, 0) + count
+        return counts
+
+    # The counts as a dict that can be saved with json, with the failures and retries from the most to the least common
+    def as_dict(self):
+        return {
+            "sentences": self.sentences,
+            "regenerated": self.regenerated,
+            "retries": self.retries,
+            "failures": [{"code": code, "rule": rule, "count": count} for (code, rule), count
+                         in sorted(self.failures.items(), key=lambda item: -item[1])],
+            "retried": [{"code": code, "rule": rule, "count": count} for (code, rule), count
+                        in sorted(self.retried.items(), key=lambda item: -item[1])],
+        }
+
+
+# GenerationStats that also profile the stages of generating sentences. Pass one as stats to
+#   Language.generate_sentences and the others to profile them. Without one, nothing is timed
+#   stage_times maps each stage to the seconds spent in it:
+#       derivation: expanding the grammar or a skeleton into Nodes
+#       lexical: choosing the words
+#       agreement, inflection: agreeing and inflecting the words
+#       retry: drawing phrases again for local retries
+#       failed: the rest of the stage an error was raised in, for sentences that were thrown away
+#   lengths maps the number of words of the sentences generated to how many there were
+#   nodes is the number of Nodes (words) derived, including those of sentences that were thrown away and those drawn
+#       again by local retries
+#   elapsed is the seconds spent generating sentences. With shards it's added up over the processes, so
+#       sentences_per_second is the speed of one process
+class GenerationProfile(GenerationStats):
+    __slots__ = ("stage_times", "lengths", "nodes", "elapsed", "_clock")
+
+    STAGES = ("derivation", "lexical", "agreement", "inflection", "retry", "failed")
+
+    def __init__(self):
+        super().__init__()
+        self.stage_times = dict.fromkeys(self.STAGES, 0.0)
+        self.lengths = {}
+        self.nodes = 0
+        self.elapsed = 0.0
+        self._clock = perf_counter()
+
+    # Start timing a stage
+    def start(self):
+        self._clock = perf_counter()
+
+    # Add the time since the last stage (or start) to stage, and start timing the next one
+    def lap(self, stage):
+        now = perf_counter()
+        self.stage_times[stage] += now - self._clock
+        self._clock = now
+
+    def update(self, other):
+        super().update(other)
+        if isinstance(other, GenerationProfile):
+            for stage, seconds in other.stage_times.items():
+                self.stage_times[stage] += seconds
+            for length, count in other.lengths.items():
+                self.lengths[length] = self.lengths.get(length, 0) + count
+            self.nodes += other.nodes
+            self.elapsed += other.elapsed
+
+    @property
+    def sentences_per_second(self):
+        return self.sentences / self.elapsed if self.elapsed else 0.0
+
+    def as_dict(self):
+        counts = super().as_dict()
+        counts.update({
+            "elapsed": self.elapsed,
+            "sentences_per_second": self.sentences_per_second,
+            "stage_times": dict(self.stage_times),
+            "nodes": self.nodes,
+            "lengths": {str(length): self.lengths[length] for length in sorted(self.lengths)},
+        })
+        return counts
+
+    # Save the profile as json at filepath
+    def dump(self, filepath):
+        with open(filepath, "w") as file:
+            json.dump(self.as_dict(), file, indent=2)
+
 
 # Method used to save sentences to a txt file
-def save_sentences(sentences, filepath):
-    # Open the file write only
-    with open(filepath, "w") as file:
-        # We want each string to be ended with a period and followed by a new line
-        # We also want the last sentence to have a period though
-        file.write(".\n".join(sentences) + ".")
-
-
-# Helper method used for probabilistic CFGs
-def choose_state(rule, is_generation):
-    choices = []
-    probabilities = []
-    # If it's generation, use the format "A": [["B", "C*p", "..."], x, ["D"], y, ...]
-    # If it's not generation it's unconditioned, use the format "A": ["a", "p1", x, "p2", y, ...]
-    # Either way we alternate between the choices and the probabilities, the only difference is that unconditioned
-    #   starts with the state of the output
-    # Iterate through the values in the list of the rule
-    for i in range(0 if is_generation else 1, len(rule), 2):
-        # The first element is going to be a choice
-        choices.append(rule[i])
-        # The second element is going to be a probability
-        probabilities.append(rule[i + 1])
-    # Returns the chosen option and optionally, the next state
-    return random.choices(choices, probabilities)[0], None if is_generation else rule[0]
+# The sentences are written a chunk at a time, so the whole file is never one string in memory
+def save_sentences(sentences, filepath, compression=None):
+    # We want each string to be ended with a period and followed by a new line
+    # We also want the last sentence to have a period though
+    # Any iterable of sentences works, they're taken a chunk at a time so a generator is never held in memory at once
+    sentences = iter(sentences)
+    with SentenceWriter(filepath, compression=compression) as writer:
+        for chunk in iter(lambda: list(islice(sentences, _SAVE_CHUNK_SIZE)), []):
+            writer.write(chunk)
+
+
+# The number of sentences save_sentences writes at a time
+_SAVE_CHUNK_SIZE = 10000
+
+# The ways files of sentences can be compressed, and the functions that open them
+_COMPRESSED_OPENERS = {"gzip": gzip.open, "bz2": bz2.open, "lzma": lzma.open}
+
+
+# Streaming version of save_sentences, for sentences that come in batches (e.g. from Language.iter_sentences)
+# The file ends up exactly the same as the one save_sentences writes with all the sentences at once
+# It's used as a context manager:
+#   with SentenceWriter(filepath) as writer:
+#       for sentences in mylang.iter_sentences(num_sentences):
+#           writer.write(sentences)
+# prefix_sizes are numbers of sentences whose ends are kept track of. If there are any, an index of the byte offset
+#   where each of them ends is saved next to the file when it's closed (see sentence_index_path). The first N sentences
+#   are exactly what save_sentences writes for them, so one file stands in for the files of every prefix, and
+#   open_sentences reads them without copying the file
+# compression is None, or "gzip", "bz2" or "lzma" to compress the file. The offsets in the index are those of the
+#   uncompressed text then, and open_sentences can't map the file
+class SentenceWriter:
+    def __init__(self, filepath, prefix_sizes=None, compression=None):
+        # Open the file write only, as bytes so that we know the offsets
+        self.filepath = filepath
+        if compression is None:
+            self.file = open(filepath, "wb")
+        elif compression in _COMPRESSED_OPENERS:
+            self.file = _COMPRESSED_OPENERS[compression](filepath, "wb")
+        else:
+            raise ValueError(f"Compression {compression} isn't supported, use one of {list(_COMPRESSED_OPENERS)}.")
+        self.num_sentences = 0
+        self.num_bytes = 0
+        self.prefix_sizes = None if prefix_sizes is None else sorted(set(prefix_sizes))
+        self.offsets = {}
+
+    # Write a batch of sentences after the ones already written
+    def write(self, sentences):
+        if not sentences:
+            return
+        # Every sentence is ended with a period, and sentences are separated by new lines
+        separator = b"\n" if self.num_sentences else b""
+        data = separator + (".\n".join(sentences) + ".").encode("utf-8")
+        # Find where the prefixes that end in this batch end
+        if self.prefix_sizes is not None:
+            for size in self.prefix_sizes:
+                if self.num_sentences < size <= self.num_sentences + len(sentences):
+                    end = (".\n".join(sentences[:size - self.num_sentences]) + ".").encode("utf-8")
+                    self.offsets[size] = self.num_bytes + len(separator) + len(end)
+        self.file.write(data)
+        self.num_sentences += len(sentences)
+        self.num_bytes += len(data)
+
+    def close(self):
+        if not self.file.closed:
+            # save_sentences writes a lone period if there are no sentences
+            if self.num_sentences == 0:
+                self.file.write(b".")
+                self.num_bytes += 1
+            self.file.close()
+            if self.prefix_sizes is not None:
+                with open(sentence_index_path(self.filepath), "w") as file:
+                    json.dump({"num_sentences": self.num_sentences, "num_bytes": self.num_bytes,
+                               "offsets": {str(size): offset for size, offset in self.offsets.items()}}, file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# SentenceWriter that writes on a thread of its own, so that generating sentences doesn't wait for the disk
+# write only puts the batch in a queue of at most max_batches batches, and waits only if it's full. The writer thread
+#   joins, encodes, compresses and writes every batch while the next ones are generated
+# It takes the same arguments as SentenceWriter, and the file is the same. An error on the writer thread is raised by
+#   the next write, or by close
+# The batches are written after write returns, so they must not be changed afterwards
+class AsyncSentenceWriter(SentenceWriter):
+    def __init__(self, filepath, prefix_sizes=None, compression=None, max_batches=8):
+        super().__init__(filepath, prefix_sizes, compression)
+        self.queue = queue.Queue(maxsize=max_batches)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    # Write the batches in the queue until close puts None in it
+    # After an error, the batches are still taken from the queue, so that write and close don't wait forever
+    def _run(self):
+        while True:
+            sentences = self.queue.get()
+            if sentences is None:
+                return
+            if self.error is None:
+                try:
+                    super().write(sentences)
+                except BaseException as error:
+                    self.error = error
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def write(self, sentences):
+        self._raise_error()
+        if sentences:
+            self.queue.put(sentences)
+
+    # Wait for the writer thread to write every batch, then close the file
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        try:
+            self._raise_error()
+        finally:
+            super().close()
+
+
+# The path of the index of prefixes SentenceWriter saves next to a file of sentences
+def sentence_index_path(filepath):
+    return filepath + ".index.json"
+
+
+# Find the byte offset where the first num_sentences sentences of a mapped file of sentences end
+# It's looked up in the index of the file, if it has one that's up to date, and otherwise found by looking for the line
+#   break after them. If the file doesn't have that many sentences, it's the end of the file
+def _sentence_offset(filepath, mapped, num_sentences):
+    index_path = sentence_index_path(filepath)
+    if os.path.exists(index_path):
+        with open(index_path) as file:
+            index = json.load(file)
+        if index["num_bytes"] == len(mapped):
+            if num_sentences >= index["num_sentences"]:
+                return len(mapped)
+            if str(num_sentences) in index["offsets"]:
+                return index["offsets"][str(num_sentences)]
+    if num_sentences <= 0:
+        return 0
+    position = -1
+    for _ in range(num_sentences):
+        position = mapped.find(b"\n", position + 1)
+        if position == -1:
+            return len(mapped)
+    return position
+
+
+# Open the first num_sentences sentences of a file that save_sentences or SentenceWriter wrote, or all of them if it's
+#   None. They're what save_sentences would have written for only those sentences
+# Returns a memoryview of their bytes, mapped into memory with mmap, so the file isn't read or copied. Decode it to get
+#   the text, e.g. str(view, "utf-8")
+def open_sentences(filepath, num_sentences=None):
+    with open(filepath, "rb") as file:
+        # Empty files can't be mapped
+        if os.fstat(file.fileno()).st_size == 0:
+            return memoryview(b"")
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    end = len(mapped) if num_sentences is None else _sentence_offset(filepath, mapped, num_sentences)
+    return memoryview(mapped)[:end]
+
+
+# Count the words of every sentence, split on whitespace
+# Returns a list with the count of every sentence, like the functions tokenizer_counter makes
+def count_words(sentences):
+    return [len(sentence.split()) for sentence in sentences]
+
+
+# Make a function that counts the tokens of every sentence like count_words does for words
+# tokenizer_path is a folder with the vocab.json and merges.txt of a byte-level BPE tokenizer, like tokenizers/frisian,
+#   which is what scripts/finetune.py trains with
+# Sentences are counted the way save_sentences writes them, with a period and a new line after each of them, so the
+#   counts add up to the tokens of the file
+# This needs the tokenizers package
+def tokenizer_counter(tokenizer_path):
+    from tokenizers import ByteLevelBPETokenizer
+    tokenizer = ByteLevelBPETokenizer(os.path.join(tokenizer_path, "vocab.json"),
+                                      os.path.join(tokenizer_path, "merges.txt"))
+
+    def count_tokens(sentences):
+        return [len(encoding.ids) for encoding in tokenizer.encode_batch([sentence + ".\n" for sentence in sentences])]
+
+    return count_tokens
+
+
+# Source of random numbers for a Language
+# With no generator, it draws from the global random and numpy.random state, exactly like the module functions do
+# With a numpy.random.Generator, it only draws from that generator, so every language (or shard) can have its own
+#   independent and reproducible stream. Single uniform numbers are drawn from it in blocks, since drawing them one at
+#   a time from a Generator is slow. A pickled copy carries on from the start of the next block
+class RandomSource:
+    __slots__ = ("generator", "random", "randrange", "choice", "random_array", "integers")
+
+    def __init__(self, generator=None):
+        self.generator = generator
+        if generator is None:
+            self.random = random.random
+            self.randrange = random.randrange
+            self.choice = random.choice
+            self.random_array = nprand.random
+            self.integers = nprand.randint
+        else:
+            # The blocks are chained into one iterator, so taking the next number doesn't run any Python code
+            blocks = iter(lambda: generator.random(1024).tolist(), None)
+            self.random = chain.from_iterable(blocks).__next__
+            self.randrange = self._randrange
+            self.choice = self._choice
+            self.random_array = generator.random
+            self.integers = generator.integers
+
+    # A uniform integer in [0, n)
+    def _randrange(self, n):
+        if n <= 0:
+            raise ValueError("empty range for randrange()")
+        return int(self.random() * n)
+
+    # A uniform element of a non-empty sequence
+    def _choice(self, sequence):
+        if not len(sequence):
+            raise IndexError("Cannot choose from an empty sequence")
+        return sequence[int(self.random() * len(sequence))]
+
+    # Only the generator is pickled, the numbers left in the current block are skipped
+    def __getstate__(self):
+        return (self.generator,)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+
+# The RandomSource that uses the global random and numpy.random state
+_GLOBAL_RANDOM = RandomSource()
+
+
+# Turn what a Language accepts as rng into a RandomSource
+# None is the global random state, a RandomSource or numpy.random.Generator is used as is, and anything else (e.g. an
+#   int or a numpy.random.SeedSequence) seeds a new numpy.random.Generator
+def random_source(rng=None):
+    if rng is None:
+        return _GLOBAL_RANDOM
+    if isinstance(rng, RandomSource):
+        return rng
+    if isinstance(rng, np.random.Generator):
+        return RandomSource(rng)
+    return RandomSource(np.random.default_rng(rng))
+
+
+# Interned vocabulary of the properties (features) of a language
+# Every feature gets an id the first time it's seen, and a set of features is an int with bit id set for each of them
+#   This way unions, differences and subset checks are bitwise operations, and a word's properties are one int
+# Ids are never reused, so the table can keep growing after compilation (e.g. for the paradigms of required words)
+class FeatureTable:
+    __slots__ = ("ids", "names", "_split_bits", "_properties")
+
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+        # Caches for paradigm strings and for turning bitsets back into properties
+        self._split_bits = {}
+        self._properties = {}
+
+    # Returns the bit of a feature, interning it if it's new
+    def intern(self, feature):
+        if feature not in self.ids:
+            self.ids[feature] = len(self.names)
+            self.names.append(feature)
+        return 1 << self.ids[feature]
+
+    # Returns the bitset of a collection of features
+    def bits(self, features):
+        bits = 0
+        for feature in features:
+            bits |= self.intern(feature)
+        return bits
+
+    # Returns the bitset of period separated features, e.g. a paradigm "p1.p2"
+    def split_bits(self, properties):
+        bits = self._split_bits.get(properties)
+        if bits is None:
+            bits = self._split_bits[properties] = self.bits(properties.split("."))
+        return bits
+
+    # Returns the list of features in a bitset, in the order they were interned
+    def properties(self, bits):
+        properties = self._properties.get(bits)
+        if properties is None:
+            properties = self._properties[bits] = tuple(name for i, name in enumerate(self.names) if bits >> i & 1)
+        return list(properties)
+
+
+# The number of derivations CompiledGrammar.skeletons enumerates at most
+_MAX_SKELETON_DERIVATIONS = 200000
+
+
+# Immutable form of a language's generation and unconditioned rules, built by Language.compile()
+# Every state is interned to an integer id, and for each state we store:
+#   kinds[id]: whether the state is a terminal part of speech, a generation rule, an unconditioned rule, or undefined
+#   cumulative_weights[id]: the running sum of the probabilities of its alternatives, so choosing one is a bisect
+#   alternatives[id]: for generation rules, a tuple of children (state id, mask of properties kept, leaves phrases)
+#                     for unconditioned rules, a tuple of (properties, opens a phrase) for each alternative
+#   next_states[id]: for unconditioned rules, the state id that the state turns into
+#   min_depths[id], min_lengths[id]: the fewest expansions below the state, and the fewest words, any derivation from
+#                                    it has. They're infinite for states that can't finish, e.g. undefined ones
+#   alternative_lengths[id]: for generation rules, the min_lengths of every alternative, and the largest of them over
+#                            the alternatives that can be chosen, see choose_bounded
+#   depth_lengths[depth]: the fewest words any derivation from every state within depth expansions has, and the
+#                         alternative_lengths of generation rules within depth expansions, so depth and length bounds
+#                         can be met together. They're added when they're first needed, see lengths_within
+# This means that the raw rules never have to be re-read or re-split while generating
+# Properties are bitsets of the features in the FeatureTable features
+# Language.compile() also attaches the language's InflectionTables, and any inflections it found that don't give
+#   exactly one affix, to inflection_tables and inflection_problems. The environments of those tables are in
+#   environment_set, and environment_masks maps every pos to the environment masks of its words, in order
+class CompiledGrammar:
+    __slots__ = ("state_ids", "state_names", "kinds", "cumulative_weights", "alternatives", "next_states", "features",
+                 "min_depths", "min_lengths", "alternative_lengths", "depth_lengths", "inflection_tables",
+                 "inflection_problems", "environment_set", "environment_masks", "agreement_rules",
+                 "agreement_requirements", "agreement_triggers", "skeleton_tables")
+
+    def __init__(self, generation_rules, unconditioned_rules, terminals):
+        # Intern the states as we come across them
+        state_ids = {}
+        state_names = []
+
+        def intern(state):
+            if state not in state_ids:
+                state_ids[state] = len(state_names)
+                state_names.append(state)
+            return state_ids[state]
+
+        features = FeatureTable()
+
+        # The start state always exists, even if the grammar forgot to define it
+        intern("S")
+        for state in list(terminals) + list(generation_rules) + list(unconditioned_rules):
+            intern(state)
+
+        # Compile every rule. We keep them in dictionaries first, since states may be interned in any order
+        compiled_rules = {}
+        for state, rule in generation_rules.items():
+            # Generation rules alternate between a list of next states and the probability of that list
+            children_choices, weights = rule[0::2], rule[1::2]
+            alternatives = []
+            for next_states in children_choices:
+                children = []
+                for next_state in next_states:
+                    # C*p means that the properties p (period separated) are removed from C
+                    # If this throws an error, it means that there was more than 1 "*" in the next_state
+                    if "*" in next_state:
+                        true_next_state, unwanted_properties = next_state.split("*")
+                        unwanted_properties = tuple(unwanted_properties.split("."))
+                    else:
+                        true_next_state, unwanted_properties = next_state, ()
+                    # Removing "__hash__" takes the child out of every phrase, so we flag it separately
+                    removes_phrases = "__hash__" in unwanted_properties
+                    kept_properties = ~features.bits(prop for prop in unwanted_properties if prop != "__hash__")
+                    children.append((intern(true_next_state), kept_properties, removes_phrases))
+                alternatives.append(tuple(children))
+            compiled_rules[state] = (_GENERATION, weights, tuple(alternatives), None)
+        for state, rule in unconditioned_rules.items():
+            # Unconditioned rules start with the output state, then alternate between properties and probabilities
+            # "__hash__" isn't a property, it opens a new phrase, so every alternative is (properties, opens phrase)
+            new_properties, weights = rule[1::2], rule[2::2]
+            alternatives = []
+            for properties in new_properties:
+                properties = properties.split(".")
+                opens_phrase = "__hash__" in properties
+                alternatives.append((features.bits(prop for prop in properties if prop != "__hash__"), opens_phrase))
+            alternatives = tuple(alternatives)
+            compiled_rules[state] = (_UNCONDITIONED, weights, alternatives, intern(rule[0][0]))
+
+        # Now that every state has an id, lay the rules out by id
+        self.state_ids = state_ids
+        self.state_names = tuple(state_names)
+        self.features = features
+        kinds = []
+        cumulative_weights = []
+        all_alternatives = []
+        next_states = []
+        for state in state_names:
+            # Terminal parts of speech take precedence over rules with the same name
+            if state in terminals:
+                kind, weights, alternatives, next_state = _TERMINAL, (), (), None
+            elif state in compiled_rules:
+                kind, weights, alternatives, next_state = compiled_rules[state]
+            # States that are referenced but never defined only raise an error if generation reaches them
+            else:
+                kind, weights, alternatives, next_state = _UNDEFINED, (), (), None
+            cumulative = tuple(accumulate(weights))
+            # random.choices would raise this error the first time the rule is used, we raise it up front
+            if kind in (_GENERATION, _UNCONDITIONED) and not (cumulative and cumulative[-1] > 0):
+                raise ValueError(f"The probabilities of the rule for {state} must sum to more than zero.")
+            kinds.append(kind)
+            cumulative_weights.append(cumulative)
+            all_alternatives.append(alternatives)
+            next_states.append(next_state)
+        self.kinds = tuple(kinds)
+        self.cumulative_weights = tuple(cumulative_weights)
+        self.alternatives = tuple(all_alternatives)
+        self.next_states = tuple(next_states)
+        self.compile_bounds()
+        self.inflection_tables = ()
+        self.inflection_problems = ()
+        self.environment_set = None
+        self.environment_masks = {}
+        self.agreement_rules = {}
+        self.agreement_requirements = ()
+        self.agreement_triggers = 0
+        # SkeletonTables by depth, made when they're first needed
+        self.skeleton_tables = {}
+
+    # Work out min_depths, min_lengths and alternative_lengths
+    # Every expansion, of a generation or an unconditioned rule, is one level deeper, like for skeletons
+    # Alternatives without weight are never chosen, so they don't count. The minimums only go down, so we update them
+    #   until nothing changes
+    def compile_bounds(self):
+        infinity = float("inf")
+        min_depths = [0 if kind == _TERMINAL else infinity for kind in self.kinds]
+        min_lengths = [1 if kind == _TERMINAL else infinity for kind in self.kinds]
+
+        # The depth and length of every alternative of a generation rule, with None for those without weight
+        def alternative_bounds(state_id):
+            cumulative = self.cumulative_weights[state_id]
+            return [(1 + max((min_depths[child] for child, _, _ in alternative), default=0),
+                     sum(min_lengths[child] for child, _, _ in alternative)) if high > low else None
+                    for alternative, low, high in zip(self.alternatives[state_id], (0,) + cumulative, cumulative)]
+
+        changed = True
+        while changed:
+            changed = False
+            for state_id, kind in enumerate(self.kinds):
+                if kind == _GENERATION:
+                    bounds = [bound for bound in alternative_bounds(state_id) if bound is not None]
+                    depth, length = min(depth for depth, _ in bounds), min(length for _, length in bounds)
+                elif kind == _UNCONDITIONED:
+                    next_state = self.next_states[state_id]
+                    depth, length = 1 + min_depths[next_state], min_lengths[next_state]
+                else:
+                    continue
+                if depth < min_depths[state_id] or length < min_lengths[state_id]:
+                    min_depths[state_id] = min(depth, min_depths[state_id])
+                    min_lengths[state_id] = min(length, min_lengths[state_id])
+                    changed = True
+
+        self.min_depths = tuple(min_depths)
+        self.min_lengths = tuple(min_lengths)
+        self.alternative_lengths = self._alternative_lengths(self.min_lengths)
+        # Within no expansions, only terminals have words, and no rule can be expanded
+        self.depth_lengths = [(tuple(1 if kind == _TERMINAL else infinity for kind in self.kinds), None)]
+
+    # The words every alternative of every generation rule gives at least, if its children give at least lengths
+    # The largest is over the alternatives that can be chosen, and it's infinite if one of them can't finish
+    def _alternative_lengths(self, lengths):
+        all_lengths = []
+        for state_id, kind in enumerate(self.kinds):
+            if kind != _GENERATION:
+                all_lengths.append(None)
+                continue
+            cumulative = self.cumulative_weights[state_id]
+            alternative_lengths = tuple(sum(lengths[child] for child, _, _ in alternative)
+                                        for alternative in self.alternatives[state_id])
+            all_lengths.append((alternative_lengths, max(
+                length for length, low, high in zip(alternative_lengths, (0,) + cumulative, cumulative) if high > low)))
+        return tuple(all_lengths)
+
+    # The entries of depth_lengths up to depth, working out the ones that are missing
+    # A state has words within depth expansions if it's a terminal, if it's an unconditioned rule whose next state has
+    #   words within depth - 1, or if it's a generation rule with an alternative whose children all do. The fewest
+    #   words of a generation rule are those of its alternative with the fewest, among those that can be chosen
+    def lengths_within(self, depth):
+        depth_lengths = self.depth_lengths
+        while len(depth_lengths) <= depth:
+            previous = depth_lengths[-1][0]
+            alternative_lengths = self._alternative_lengths(previous)
+            lengths = []
+            for state_id, kind in enumerate(self.kinds):
+                if kind == _GENERATION:
+                    cumulative = self.cumulative_weights[state_id]
+                    lengths.append(min(length for length, low, high in zip(alternative_lengths[state_id][0],
+                                                                          (0,) + cumulative, cumulative)
+                                       if high > low))
+                elif kind == _UNCONDITIONED:
+                    lengths.append(previous[self.next_states[state_id]])
+                else:
+                    lengths.append(previous[state_id])
+            depth_lengths.append((tuple(lengths), alternative_lengths))
+        return depth_lengths
+
+    # Compile the agreement rules of a language
+    # agreement_rules maps the bit of each property or terminal that takes agreement to (rule, requirement id, sought
+    #   features), where the sought features are pairs of each feature and the bitset of its properties
+    # The requirement is the pair of the bitset of the properties the controller must have (without "__hash__") and
+    #   whether it must be in this word's phrases. Rules with the same requirement share its id, so a sentence only has
+    #   to be indexed once for each of them
+    # agreement_triggers is the bitset of all the properties that take agreement
+    def compile_agreement_rules(self, agreement_rules):
+        features = self.features
+        requirement_ids = {}
+        compiled_rules = {}
+        for trigger, rule in agreement_rules.items():
+            required_properties = set(rule[0])
+            requirement = (features.bits(required_properties - {"__hash__"}), "__hash__" in required_properties)
+            requirement_id = requirement_ids.setdefault(requirement, len(requirement_ids))
+            sought_features = tuple((feature, features.bits(feature)) for feature in rule[1])
+            compiled_rules[features.intern(trigger)] = (rule, requirement_id, sought_features)
+        self.agreement_rules = compiled_rules
+        self.agreement_requirements = tuple(requirement_ids)
+        self.agreement_triggers = sum(compiled_rules)
+
+    # Find every set of properties each terminal part of speech can be generated with
+    # Returns a dictionary from terminal pos to a set of frozensets of properties
+    # Phrases aren't properties, so "__hash__" is never in these sets
+    def terminal_properties(self):
+        start = (self.state_ids["S"], 0)
+        seen = {start}
+        stack = [start]
+        terminal_properties = {}
+        while stack:
+            state_id, properties = stack.pop()
+            kind = self.kinds[state_id]
+            if kind == _TERMINAL:
+                terminal_properties.setdefault(self.state_names[state_id], set()).add(
+                    frozenset(self.features.properties(properties)))
+                continue
+            # Every alternative of a generation rule can give each of its children
+            if kind == _GENERATION:
+                next_states = [(next_state_id, properties & kept_properties)
+                               for alternative in self.alternatives[state_id]
+                               for next_state_id, kept_properties, _ in alternative]
+            # Every alternative of an unconditioned rule adds different properties to the same next state
+            elif kind == _UNCONDITIONED:
+                next_states = [(self.next_states[state_id], properties | new_properties)
+                               for new_properties, _ in self.alternatives[state_id]]
+            else:
+                continue
+            for next_state in next_states:
+                if next_state not in seen:
+                    seen.add(next_state)
+                    stack.append(next_state)
+        return terminal_properties
+
+    # Get the SkeletonTable of the derivations up to depth expansions below the start state
+    # The derivations are enumerated with the probabilities that expanding the grammar gives them, merging the ones
+    #   that give the same skeleton. A state at the depth bound is left in the skeleton to be expanded as usual
+    # Raises an error if there are more than max_derivations derivations, since then the depth is too large to help
+    def skeletons(self, depth, max_derivations=_MAX_SKELETON_DERIVATIONS):
+        table = self.skeleton_tables.get(depth)
+        if table is not None:
+            return table
+        probabilities = {}
+        phrase_counts = {}
+        all_roots = {}
+        num_derivations = 0
+
+        # Expand a partial derivation until it has to choose an alternative, and then every alternative in turn
+        # The stack is the same as in Language._derive, with the depth of every state added
+        # The phrases are kept track of like Language._expand does, with the items they span instead of the words
+        def expand(stack, items, next_phrase, probability, roots, open_phrases):
+            nonlocal num_derivations
+            while stack:
+                while open_phrases and len(stack) <= open_phrases[-1][1]:
+                    roots[open_phrases.pop()[0]][2] = len(items)
+                state_id, properties, phrases, state_depth = stack.pop()
+                kind = self.kinds[state_id]
+                # Terminals are done, and states past the depth bound are expanded for every sentence
+                # Undefined states raise their error when they're expanded too
+                if kind not in (_GENERATION, _UNCONDITIONED) or state_depth >= depth:
+                    items.append((state_id, properties, phrases))
+                    continue
+                cumulative = self.cumulative_weights[state_id]
+                for alternative, low, high in zip(self.alternatives[state_id], (0,) + cumulative, cumulative):
+                    # choose never picks an alternative without weight
+                    if high <= low:
+                        continue
+                    next_stack = stack.copy()
+                    next_phrase_id = next_phrase
+                    next_roots = {phrase: span.copy() for phrase, span in roots.items()}
+                    next_open_phrases = open_phrases.copy()
+                    if kind == _GENERATION:
+                        for next_state_id, kept_properties, leaves_phrases in reversed(alternative):
+                            next_stack.append((next_state_id, properties & kept_properties,
+                                               () if leaves_phrases else phrases, state_depth + 1))
+                    else:
+                        new_properties, opens_phrase = alternative
+                        next_phrases = phrases
+                        if opens_phrase:
+                            next_roots[next_phrase_id] = [(state_id, properties, phrases), len(items), None]
+                            next_open_phrases.append((next_phrase_id, len(next_stack)))
+                            next_phrases += (next_phrase_id,)
+                            next_phrase_id += 1
+                        next_stack.append((self.next_states[state_id], properties | new_properties, next_phrases,
+                                           state_depth + 1))
+                    expand(next_stack, items.copy(), next_phrase_id, probability * (high - low) / cumulative[-1],
+                           next_roots, next_open_phrases)
+                return
+            num_derivations += 1
+            if num_derivations > max_derivations:
+                raise ValueError(f"The grammar has more than {max_derivations} derivations up to depth {depth}. "
+                                 f"Use a smaller skeleton depth.")
+            for phrase, _ in open_phrases:
+                roots[phrase][2] = len(items)
+            items = tuple(items)
+            probabilities[items] = probabilities.get(items, 0) + probability
+            phrase_counts[items] = next_phrase
+            all_roots.setdefault(items, tuple((phrase, root, start, stop)
+                                              for phrase, (root, start, stop) in roots.items()))
+
+        expand([(self.state_ids["S"], 0, (), 0)], [], 0, 1.0, {}, [])
+        table = self.skeleton_tables[depth] = SkeletonTable(
+            self, [Skeleton(self, items, phrase_counts[items], probability, all_roots[items])
+                   for items, probability in probabilities.items()])
+        return table
+
+    # Choose one of the alternatives of a state according to its probabilities, with the RandomSource rng
+    # This draws from random exactly the way random.choices does, so the same seed gives the same choices
+    def choose(self, state_id, rng=_GLOBAL_RANDOM):
+        cumulative = self.cumulative_weights[state_id]
+        return self.alternatives[state_id][bisect(cumulative, rng.random() * cumulative[-1], 0,
+                                                  len(cumulative) - 1)]
+
+    # Choose one of the alternatives of a generation rule like choose, among those that can give at most length more
+    #   words. alternative_lengths are the state's entry of alternative_lengths, or of depth_lengths for the expansions
+    #   left at the state if there's a depth bound
+    # The probabilities of the alternatives that fit are renormalized. If every alternative fits, this is choose
+    # There's always an alternative that fits as long as the state itself fits, so if none does the bounds were worked
+    #   out wrong, and we raise an error rather than choose one that doesn't fit
+    def choose_bounded(self, state_id, rng, alternative_lengths, length):
+        lengths, max_length = alternative_lengths
+        # Alternatives that can't finish are infinitely long, and never fit even if length is infinite
+        if max_length <= length and max_length < float("inf"):
+            return self.choose(state_id, rng)
+        cumulative = tuple(accumulate(high - low if alternative_length <= length and alternative_length < float("inf")
+                                      else 0 for low, high, alternative_length
+                                      in zip((0,) + self.cumulative_weights[state_id],
+                                             self.cumulative_weights[state_id], lengths)))
+        if not cumulative[-1] > 0:
+            raise ValueError(f"No alternative of {self.state_names[state_id]} fits within {length} words.")
+        return self.alternatives[state_id][bisect(cumulative, rng.random() * cumulative[-1], 0, len(cumulative) - 1)]
+
+
+# A sentence skeleton: the parts of speech and properties of the words of a sentence, before words are chosen
+# items are the (state id, properties, phrases) of the skeleton in sentence order. States that aren't terminals were
+#   past the depth bound of the SkeletonTable, and are expanded when the skeleton is used
+# roots are the (phrase, root, start, stop) of the phrases of the skeleton, where items[start:stop] are in the
+#   phrase, for local retries (see Language._resample_phrase)
+# For skeletons that are all terminals, the agreement links and inflection slots are worked out once here:
+# - links are (position, controller position, sought features) for every word that agrees, or None if agreement
+#   fails, like Language._agree would find with words whose paradigms have no properties agreement looks at
+# - slots are the inflection tables of every word, for words whose paradigms and agreement don't trigger others
+class Skeleton:
+    __slots__ = ("items", "num_phrases", "probability", "roots", "is_complete", "features", "links", "slots")
+
+    def __init__(self, grammar, items, num_phrases, probability, roots):
+        self.items = items
+        self.num_phrases = num_phrases
+        self.probability = probability
+        self.roots = roots
+        self.is_complete = all(grammar.kinds[state_id] == _TERMINAL for state_id, _, _ in items)
+        self.features = None
+        self.links = None
+        self.slots = None
+        if not self.is_complete:
+            return
+        # The features of every word before agreement, apart from the properties of its paradigm
+        features = grammar.features
+        self.features = tuple(properties | features.intern(grammar.state_names[state_id])
+                              for state_id, properties, _ in items)
+        self.links = self._link(grammar)
+        self.slots = tuple(tuple(table for table in grammar.inflection_tables if table.trigger_bit & word_features)
+                           for word_features in self.features)
+
+    # Find the word every word agrees with, the same way Language._agree does
+    def _link(self, grammar):
+        links = []
+        for position, word_features in enumerate(self.features):
+            agreement_properties = word_features & grammar.agreement_triggers
+            if not agreement_properties:
+                continue
+            # Words with more than one agreement fail in Language._agree
+            if agreement_properties & (agreement_properties - 1):
+                return None
+            _, requirement_id, sought_features = grammar.agreement_rules[agreement_properties]
+            required_properties, needs_hash = grammar.agreement_requirements[requirement_id]
+            phrases = set(self.items[position][2])
+            controllers = [candidate for candidate, candidate_features in enumerate(self.features)
+                           if candidate_features & required_properties == required_properties
+                           and not (needs_hash and phrases and not phrases <= set(self.items[candidate][2]))]
+            # There must be exactly one word triggering agreement
+            if len(controllers) != 1:
+                return None
+            links.append((position, controllers[0], sought_features))
+        return tuple(links)
+
+
+# The distribution of the Skeletons of a grammar up to a depth, see CompiledGrammar.skeletons
+# agreement_properties are the properties that agreement depends on, and inflection_triggers the ones that trigger
+#   inflection tables. Skeletons can only use their links and slots if the words' paradigms don't add any of them
+class SkeletonTable:
+    __slots__ = ("skeletons", "cumulative_probabilities", "agreement_properties", "inflection_triggers")
+
+    def __init__(self, grammar, skeletons):
+        # The most likely skeletons come first, which makes no difference to the distribution
+        self.skeletons = tuple(sorted(skeletons, key=lambda skeleton: -skeleton.probability))
+        self.cumulative_probabilities = tuple(accumulate(skeleton.probability for skeleton in self.skeletons))
+        self.agreement_properties = grammar.agreement_triggers
+        for required_properties, _ in grammar.agreement_requirements:
+            self.agreement_properties |= required_properties
+        self.inflection_triggers = 0
+        for table in grammar.inflection_tables:
+            self.inflection_triggers |= table.trigger_bit
+
+    # Draw a skeleton with the RandomSource rng
+    def sample(self, rng):
+        cumulative = self.cumulative_probabilities
+        return self.skeletons[bisect(cumulative, rng.random() * cumulative[-1], 0, len(cumulative) - 1)]
+
+
+# Walker alias table for Zipf's distribution truncated to the words of one part of speech
+# Index k (starting from 0) is drawn with probability proportional to (k + 1) ** -skew. This is the distribution that
+#   drawing from nprand.zipf until the index fits in the list gives, but every draw takes exactly one uniform number
+#   instead of retrying, which matters a lot for small parts of speech
+class ZipfSampler:
+    __slots__ = ("size", "skew", "probabilities", "aliases", "_probability_list", "_alias_list")
+
+    def __init__(self, size, skew):
+        # We can't draw from an empty part of speech
+        if size <= 0:
+            raise ValueError("Can't sample from a part of speech with no words.")
+        self.size = size
+        self.skew = skew
+        # The weights of each index, scaled so that they average to 1
+        weights = np.arange(1, size + 1, dtype=np.float64) ** -skew
+        scaled = weights * (size / weights.sum())
+        # Build the table with Vose's method. Every column is filled up to 1 by exactly one "large" index
+        probabilities = np.ones(size)
+        aliases = np.arange(size)
+        small = np.flatnonzero(scaled < 1).tolist()
+        large = np.flatnonzero(scaled >= 1).tolist()
+        scaled = scaled.tolist()
+        while small and large:
+            small_index, large_index = small.pop(), large.pop()
+            probabilities[small_index] = scaled[small_index]
+            aliases[small_index] = large_index
+            # The large index gave away some of its weight, so it may be small now
+            scaled[large_index] += scaled[small_index] - 1
+            (small if scaled[large_index] < 1 else large).append(large_index)
+        # Anything left over is 1 up to rounding error, so it keeps its own column
+        self.probabilities = probabilities
+        self.aliases = aliases
+        # Python lists are much faster than arrays to index one value at a time
+        self._probability_list = probabilities.tolist()
+        self._alias_list = aliases.tolist()
+
+    # Draw a single index with the RandomSource rng
+    def sample(self, rng=_GLOBAL_RANDOM):
+        # The integer part chooses the column and the fractional part chooses between the column and its alias
+        position = rng.random() * self.size
+        column = int(position)
+        return column if position - column < self._probability_list[column] else self._alias_list[column]
+
+    # Draw an array of count indices with one NumPy call
+    def sample_batch(self, count, rng=_GLOBAL_RANDOM):
+        positions = rng.random_array(count) * self.size
+        columns = positions.astype(np.int64)
+        return np.where(positions - columns < self.probabilities[columns], columns, self.aliases[columns])
+
+
+# Samples new word forms for Language.generate_words
+# A word has a Poisson(syllable_lambda) + 1 number of syllables, every syllable has a uniformly chosen structure from
+#   syllables, and every natural class in the structure is a uniformly chosen phoneme of that class
+# The form space is indexed by syllable ids: the concrete syllables of structure s are offsets[s], ...,
+#   offsets[s + 1] - 1, in the order of their phonemes, so a word with k syllables is a sequence of k syllable ids
+# New words are sampled without replacement, which is the distribution you get by drawing words until one isn't
+#   taken yet. Instead of retrying, which gets stuck when the short words run out:
+#   - The buckets of words with up to max_enumerated syllables (at most _ENUMERATED_BUCKET_SIZE sequences each) are
+#     enumerated once. Each of them is chosen with the probability of its syllable count times the probability of the
+#     words in it that are still available, and then one of those words is drawn
+#   - Longer words are drawn from their syllable count conditioned on being longer, and syllables are drawn with NumPy
+#     in batches. There are so many of them that they are rarely taken, and if they are, they're drawn again. If
+#     most of them are taken, the shortest syllable count left is skipped from then on
+class WordFormSampler:
+    __slots__ = ("phonemes", "structures", "syllable_lambda", "sizes", "offsets", "num_syllables",
+                 "syllable_probabilities", "_syllables", "_buckets")
+
+    def __init__(self, phonemes, syllables, syllable_lambda):
+        if not syllables:
+            raise ValueError("Can't generate words without syllables.")
+        self.phonemes = phonemes
+        self.syllable_lambda = syllable_lambda
+        # Every structure is the list of phonemes of each of its natural classes
+        self.structures = [[phonemes[natural_class] for natural_class in structure] for structure in syllables]
+        sizes = []
+        for structure, classes in zip(syllables, self.structures):
+            if not all(classes):
+                raise ValueError(f"Syllable structure {structure} has a natural class with no phonemes.")
+            sizes.append(int(np.prod([len(phonemes) for phonemes in classes])))
+        self.sizes = np.array(sizes, dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(self.sizes)])
+        self.num_syllables = int(self.offsets[-1])
+        # Every concrete syllable of a structure is as likely as the others
+        self.syllable_probabilities = 1 / (len(self.sizes) * np.repeat(self.sizes, self.sizes))
+        self._syllables = {}
+        # Maps a syllable count to (unique forms, their probabilities, form positions, shortest and longest form)
+        self._buckets = {}
+
+    # The form of a syllable id
+    def syllable(self, syllable_id):
+        form = self._syllables.get(syllable_id)
+        if form is None:
+            structure = bisect(self.offsets, syllable_id) - 1
+            index = syllable_id - int(self.offsets[structure])
+            # The last natural class changes fastest
+            phonemes = []
+            for members in reversed(self.structures[structure]):
+                index, member = divmod(index, len(members))
+                phonemes.append(members[member])
+            form = self._syllables[syllable_id] = "".join(reversed(phonemes))
+        return form
+
+    # The largest syllable count whose bucket is enumerated, when taken words are taken
+    # With a single syllable every bucket has one word, so there have to be enough of them for all the new words
+    def max_enumerated(self, num_words, taken):
+        if self.num_syllables == 1:
+            return len(taken) + num_words + 1
+        max_enumerated = 0
+        while self.num_syllables ** (max_enumerated + 1) <= _ENUMERATED_BUCKET_SIZE:
+            max_enumerated += 1
+        return max_enumerated
+
+    # Enumerate the unique forms with num_syllables syllables and the probability of each of them
+    # Different syllable sequences can spell the same form, so their probabilities are added up
+    def _bucket(self, num_syllables):
+        bucket = self._buckets.get(num_syllables)
+        if bucket is None:
+            syllables = np.array([self.syllable(syllable_id) for syllable_id in range(self.num_syllables)],
+                                 dtype=object)
+            # Add one syllable at a time, with the last syllable changing fastest
+            forms = syllables
+            probabilities = self.syllable_probabilities
+            for _ in range(num_syllables - 1):
+                forms = np.add.outer(forms, syllables).ravel()
+                probabilities = np.multiply.outer(probabilities, self.syllable_probabilities).ravel()
+            forms, inverse = np.unique(forms.astype(str), return_inverse=True)
+            forms = forms.astype(object)
+            lengths = [len(form) for form in forms]
+            bucket = self._buckets[num_syllables] = (forms, np.bincount(inverse, probabilities),
+                                                     {form: i for i, form in enumerate(forms)},
+                                                     min(lengths), max(lengths))
+        return bucket
+
+    # The log of the probability that a word has num_syllables syllables
+    def _log_count_probability(self, num_syllables):
+        lam = self.syllable_lambda
+        if lam <= 0:
+            return 0.0 if num_syllables == 1 else -np.inf
+        return -lam + (num_syllables - 1) * log(lam) - lgamma(num_syllables)
+
+    # The distribution of the syllable counts from first on, as the counts, their cumulative probabilities, and the
+    #   log of the probability of having at least first syllables
+    # The probabilities are worked out in log space, since they can be too small for floats. The counts stop where
+    #   the probabilities are negligible
+    def _long_syllable_counts(self, first):
+        lam = self.syllable_lambda
+        counts = np.arange(first, first + int(lam + 10 * lam ** 0.5) + 50)
+        log_probabilities = np.array([self._log_count_probability(count) for count in counts.tolist()])
+        largest = log_probabilities.max()
+        probabilities = np.exp(log_probabilities - largest)
+        return counts, np.cumsum(probabilities / probabilities.sum()), largest + log(probabilities.sum())
+
+    # Draw count forms with num_syllables syllables independently
+    def _draw(self, num_syllables, count, rng):
+        structures = rng.integers(0, len(self.sizes), (count, num_syllables))
+        indices = (rng.random_array((count, num_syllables)) * self.sizes[structures]).astype(np.int64)
+        syllable_ids = (self.offsets[structures] + indices).tolist()
+        return ["".join([self.syllable(syllable_id) for syllable_id in word]) for word in syllable_ids]
+
+    # Sample num_words new forms that are all different and not in taken, drawing from the RandomSource rng
+    # The forms are in the order they were drawn
+    def sample(self, num_words, taken, rng):
+        max_enumerated = self.max_enumerated(num_words, taken)
+        buckets = [self._bucket(num_syllables) for num_syllables in range(1, max_enumerated + 1)]
+        available = [np.fromiter((form not in taken for form in forms), bool, len(forms))
+                     for forms, _, _, _, _ in buckets]
+        count_log_probabilities = [self._log_count_probability(count) for count in range(1, max_enumerated + 1)]
+        long_counts, long_cumulative, long_log_probability = self._long_syllable_counts(max_enumerated + 1)
+        new_forms = []
+        new_form_set = set()
+        while len(new_forms) < num_words:
+            needed = num_words - len(new_forms)
+            # Choose the buckets of a batch of words, the last one being all the longer words
+            # We work in log space, since the probabilities of long words can be too small for floats
+            log_weights = []
+            for count_log_probability, (_, probabilities, _, _, _), bucket_available \
+                    in zip(count_log_probabilities, buckets, available):
+                available_probability = probabilities[bucket_available].sum()
+                log_weights.append(count_log_probability + log(available_probability) if available_probability > 0
+                                   else -np.inf)
+            log_weights.append(long_log_probability)
+            log_weights = np.array(log_weights)
+            cumulative = np.cumsum(np.exp(log_weights - log_weights.max()))
+            choices = np.searchsorted(cumulative, rng.random_array(needed) * cumulative[-1], side="right")
+            choices = np.minimum(choices, len(buckets))
+            candidates = np.empty(needed, dtype=object)
+            long_positions = np.flatnonzero(choices == len(buckets))
+            for bucket_index in np.unique(choices).tolist():
+                positions = np.flatnonzero(choices == bucket_index)
+                # Draw the words of a long bucket independently, grouped by their syllable count
+                if bucket_index == len(buckets):
+                    num_syllables = long_counts[np.minimum(np.searchsorted(long_cumulative,
+                                                                           rng.random_array(len(positions)),
+                                                                           side="right"), len(long_counts) - 1)]
+                    for count in np.unique(num_syllables).tolist():
+                        count_positions = positions[num_syllables == count]
+                        candidates[count_positions] = self._draw(count, len(count_positions), rng)
+                    continue
+                # Draw the words of an enumerated bucket from the ones that are still available
+                forms, probabilities, _, _, _ = buckets[bucket_index]
+                indices = np.flatnonzero(available[bucket_index])
+                form_cumulative = np.cumsum(probabilities[indices])
+                drawn = np.searchsorted(form_cumulative, rng.random_array(len(positions)) * form_cumulative[-1],
+                                        side="right")
+                candidates[positions] = forms[indices[np.minimum(drawn, len(indices) - 1)]]
+            # Keep the words in the order they were drawn, skipping the ones that are taken by now
+            long_accepted = 0
+            for form, is_long in zip(candidates.tolist(), (choices == len(buckets)).tolist()):
+                if form in taken or form in new_form_set:
+                    continue
+                new_forms.append(form)
+                new_form_set.add(form)
+                long_accepted += is_long
+                # The form isn't available in any bucket anymore
+                for (_, _, positions, shortest, longest), bucket_available in zip(buckets, available):
+                    if shortest <= len(form) <= longest and form in positions:
+                        bucket_available[positions[form]] = False
+            # If most long words were taken, the shortest of them are running out. We skip that syllable count, so
+            #   that drawing never gets stuck, at the cost of not quite sampling without replacement
+            if len(long_positions) and 2 * long_accepted < len(long_positions):
+                long_counts, long_cumulative, long_log_probability = self._long_syllable_counts(long_counts[0] + 1)
+        return new_forms
+
+
+# The largest bucket of WordFormSampler that is enumerated
+_ENUMERATED_BUCKET_SIZE = 1 << 16
+
+
+# A lexicon of base forms for Language.set_dictionary, read in one pass from a dictionary in the format that
+#   set_dictionary takes. It doesn't depend on any language, so it can be set on as many languages as needed
+# Every pos has an array of forms and an array of paradigm ids, which index into paradigms[pos]. A pos that maps to a
+#   list has the single paradigm f'{pos}_main'
+# word_set is every form in the lexicon, and duplicates the ones that are in it more than once, in any pos. The
+#   duplicates are kept, like add_word does
+class Lexicon:
+    __slots__ = ("parts_of_speech", "forms", "paradigm_ids", "paradigms", "word_set", "duplicates", "_words")
+
+    def __init__(self, imported_dictionary):
+        self.forms = {}
+        self.paradigm_ids = {}
+        self.paradigms = {}
+        for pos, lexemes_or_classes in imported_dictionary.items():
+            if type(lexemes_or_classes) is list:
+                lexemes_or_classes = {f'{pos}_main': lexemes_or_classes}
+            elif type(lexemes_or_classes) is not dict:
+                raise Exception("Values for parts of speech not lists or dictionaries")
+            self.paradigms[pos] = list(lexemes_or_classes)
+            forms = np.empty(sum(len(lexemes) for lexemes in lexemes_or_classes.values()), dtype=object)
+            forms[:] = list(chain.from_iterable(lexemes_or_classes.values()))
+            self.forms[pos] = forms
+            self.paradigm_ids[pos] = np.repeat(np.arange(len(lexemes_or_classes), dtype=np.int32),
+                                               [len(lexemes) for lexemes in lexemes_or_classes.values()])
+        self.parts_of_speech = list(self.forms)
+        # Find the duplicates of every pos at once
+        all_forms = np.concatenate([np.empty(0, dtype=object)] + list(self.forms.values()))
+        unique_forms, counts = np.unique(all_forms, return_counts=True)
+        self.word_set = frozenset(unique_forms.tolist())
+        self.duplicates = unique_forms[counts > 1]
+        # The entries of each pos as the (form, paradigm) tuples of Language.words, made when they're first needed
+        self._words = {}
+
+    # The entries of a pos as a list of (form, paradigm) tuples
+    # The list is shared between calls, so it must be copied before it's changed
+    def words(self, part_of_speech):
+        words = self._words.get(part_of_speech)
+        if words is None:
+            paradigms = np.array(self.paradigms[part_of_speech], dtype=object)
+            words = self._words[part_of_speech] = list(zip(self.forms[part_of_speech].tolist(),
+                                                           paradigms[self.paradigm_ids[part_of_speech]].tolist()))
+        return words
+
+
+# Lexicons that load_lexicon has read, by path, with the modification time of their file
+_LEXICONS = {}
+
+
+# Load a Lexicon from a JSON file in the format of Language.set_dictionary
+# A file is only parsed once per process, unless it changes
+def load_lexicon(filepath):
+    filepath = os.path.abspath(filepath)
+    modified = os.path.getmtime(filepath)
+    cached = _LEXICONS.get(filepath)
+    if cached is None or cached[0] != modified:
+        with open(filepath, "r") as file:
+            cached = _LEXICONS[filepath] = (modified, Lexicon(json.load(file)))
+    return cached[1]
+
+
+# The lexicon arrays of a snapshot from Language.dump_snapshot, mapped into memory
+# forms is the UTF-8 of every form one after the other, form_offsets[i] is where form i starts, and paradigm_ids[i]
+#   indexes into the paradigms of the pos of form i. environment_masks[i] is the environment mask of form i (see
+#   EnvironmentSet.masks) in 64 bit columns, lowest first. The pages of the files are shared by every process that maps
+#   them
+class _MappedLexicon:
+    __slots__ = ("directory_path", "forms", "form_offsets", "paradigm_ids", "environment_masks")
+
+    def __init__(self, directory_path):
+        self.directory_path = directory_path
+        for name in ("forms", "form_offsets", "paradigm_ids", "environment_masks"):
+            setattr(self, name, np.load(os.path.join(directory_path, f"{name}.npy"), mmap_mode="r"))
+
+
+# Mapped lexicons by the absolute path of their snapshot, so a process maps every snapshot only once
+_MAPPED_LEXICONS = {}
+
+
+def _mapped_lexicon(directory_path):
+    directory_path = os.path.abspath(directory_path)
+    lexicon = _MAPPED_LEXICONS.get(directory_path)
+    if lexicon is None:
+        lexicon = _MAPPED_LEXICONS[directory_path] = _MappedLexicon(directory_path)
+    return lexicon
+
+
+# A list of the entries start to stop of the mapped lexicon of a snapshot, that are read as they're used
+# Entries are decoded when they're first used, so a language only holds the ones it has generated with
+# The first change turns it into a normal list, so the snapshot itself never changes
+# Pickling only stores where the entries are, so a worker process maps the same files instead of getting a copy
+# Subclasses decode the entries, with _decode for one of them and _decode_all for all of them at once
+class _MappedSequence(MutableSequence):
+    __slots__ = ("directory_path", "start", "stop", "_lexicon", "_decoded", "_list")
+
+    def __init__(self, directory_path, start, stop):
+        self.directory_path = directory_path
+        self.start = start
+        self.stop = stop
+        self._lexicon = _mapped_lexicon(directory_path)
+        self._decoded = {}
+        self._list = None
+
+    def __reduce__(self):
+        if self._list is not None:
+            return list, (self._list,)
+        return type(self), (self.directory_path, self.start, self.stop)
+
+    def __len__(self):
+        return self.stop - self.start if self._list is None else len(self._list)
+
+    def __getitem__(self, index):
+        if self._list is not None:
+            return self._list[index]
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        entry = self._decoded.get(index)
+        if entry is None:
+            if not -len(self) <= index < len(self):
+                raise IndexError("list index out of range")
+            index %= len(self)
+            entry = self._decoded.get(index)
+            if entry is None:
+                entry = self._decoded[index] = self._decode(self.start + index)
+        return entry
+
+    def __iter__(self):
+        if self._list is not None:
+            return iter(self._list)
+        return iter(self._decode_all())
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+    # Copy the entries into a normal list before the first change
+    def _materialize(self):
+        if self._list is None:
+            self._list = list(self)
+            self._decoded = None
+        return self._list
+
+    def __setitem__(self, index, entry):
+        self._materialize()[index] = entry
+
+    def __delitem__(self, index):
+        del self._materialize()[index]
+
+    def insert(self, index, entry):
+        self._materialize().insert(index, entry)
+
+    def extend(self, entries):
+        self._materialize().extend(entries)
+
+
+# The words of a pos in a snapshot, as a list of (form, paradigm) tuples that are read from the mapped lexicon
+class MappedWords(_MappedSequence):
+    __slots__ = ("paradigms",)
+
+    def __init__(self, directory_path, start, stop, paradigms):
+        super().__init__(directory_path, start, stop)
+        self.paradigms = paradigms
+
+    def __reduce__(self):
+        if self._list is not None:
+            return list, (self._list,)
+        return MappedWords, (self.directory_path, self.start, self.stop, self.paradigms)
+
+    def _decode(self, i):
+        lexicon = self._lexicon
+        form = lexicon.forms[lexicon.form_offsets[i]:lexicon.form_offsets[i + 1]].tobytes().decode()
+        return form, self.paradigms[lexicon.paradigm_ids[i]]
+
+    def _decode_all(self):
+        lexicon = self._lexicon
+        offsets = lexicon.form_offsets[self.start:self.stop + 1].tolist()
+        forms = lexicon.forms[offsets[0]:offsets[-1]].tobytes()
+        paradigms = [self.paradigms[paradigm_id] for paradigm_id
+                     in lexicon.paradigm_ids[self.start:self.stop].tolist()]
+        return [(forms[start - offsets[0]:stop - offsets[0]].decode(), paradigm)
+                for start, stop, paradigm in zip(offsets, offsets[1:], paradigms)]
+
+
+# The environment masks of the words of a pos in a snapshot, as a list of integers like CompiledGrammar's
+class MappedEnvironmentMasks(_MappedSequence):
+    __slots__ = ()
+
+    def _decode(self, i):
+        return _join_mask(self._lexicon.environment_masks[i].tolist())
+
+    def _decode_all(self):
+        return [_join_mask(columns) for columns in self._lexicon.environment_masks[self.start:self.stop].tolist()]
+
+
+# Join the 64 bit columns of an environment mask, lowest first, into one integer
+def _join_mask(columns):
+    mask = 0
+    for i, column in enumerate(columns):
+        mask |= column << (64 * i)
+    return mask
+
+
+# Load a Language object from a snapshot made with Language.dump_snapshot
+# Only the rules and compiled grammar are read in, the lexicon is mapped into memory and read as it's used, so this is
+#   fast enough to do in every worker process, and they all share the same lexicon
+# Snapshots are pickled, so only load snapshots you trust
+# rng is the random number generator of the language, see Language
+def load_snapshot(directory_path, rng=None):
+    with open(os.path.join(directory_path, "language.pickle"), "rb") as file:
+        data = pickle.load(file)
+    if data["version"] != _SNAPSHOT_VERSION:
+        raise ValueError(f"Snapshot version {data['version']} isn't supported, expected {_SNAPSHOT_VERSION}.")
+    new_language = Language(rng=rng)
+    for name in ("phonemes", "syllables", "syllable_lambda", "generation_rules", "unconditioned_rules",
+                 "agreement_rules", "inflection_paradigms"):
+        setattr(new_language, name, data[name])
+    new_language.words = {pos: MappedWords(directory_path, start, stop, paradigms)
+                          for pos, (start, stop, paradigms) in data["lexicon"].items()}
+    # The word set is made from the lexicon when it's first needed
+    new_language.word_set = None
+    # The environment masks are in the lexicon too, aligned with the words
+    grammar = new_language._compiled = data["grammar"]
+    grammar.environment_masks = {pos: MappedEnvironmentMasks(directory_path, start, stop)
+                                 for pos, (start, stop, _) in data["lexicon"].items()}
+    return new_language
+
+
+# The fields of a Language that a copy shares with it until one of them changes the field
+_SHARED_FIELDS = ("phonemes", "syllables", "generation_rules", "unconditioned_rules", "agreement_rules", "words",
+                  "word_set", "inflection_paradigms")
+
+
+# The version of the snapshot format of Language.dump_snapshot
+_SNAPSHOT_VERSION = 6
 
 
 # Load a Language object form a file
-def load_language(directory_path):
+# rng is the random number generator of the language, see Language
+def load_language(directory_path, rng=None):
     # Retrieve it from JSON format
     with open(os.path.join(directory_path, "mylang.json"), "r") as file:
         data = json.load(file)
     # Create an object with that data
-    new_language = Language()
+    new_language = Language(rng=rng)
     new_language.phonemes = data["phonemes"]
     new_language.syllables = data["syllables"]
     new_language.syllable_lambda = data["syllable_lambda"]
@@ -60,169 +1405,568 @@ def load_language(directory_path):
     return new_language
 
 
+# A parsed allophonic environment from an inflection paradigm, such as "/C_" or "/*je_"
+# The part before the underscore is the environment to the left of a suffix, the part after is the environment to
+#   the right of a prefix. Every character is a natural class in phonemes or a phoneme, and an asterisk negates the
+#   character after it, so "*je" means a phoneme that isn't "j" followed by "e"
+class PhonologicalEnvironment:
+    __slots__ = ("environment", "is_suffix", "length", "checks")
+
+    def __init__(self, environment, phonemes):
+        self.environment = environment
+        # Get the environment before and after the underscore
+        left_environment, right_environment = environment.split("_")
+        # We don't want circumfixes or environments that rely on right and left phonemes
+        assert not (left_environment and right_environment)
+        if not (left_environment or right_environment):
+            raise Exception("Unknown error! Neither left nor right environment.")
+        # If it's a suffix, we look at the phonemes at the end of the word, otherwise at the start
+        self.is_suffix = bool(left_environment)
+        environment = left_environment or right_environment
+        # The number of phonemes the environment looks at
+        self.length = len(environment.replace("*", ""))
+        # For every phoneme the environment looks at, store the phonemes that match it and whether it's negated
+        checks = []
+        num_asterisks = 0
+        for i in range(self.length):
+            is_asterisk = False
+            # If it's an asterisk, the following character is negative
+            if environment[i] == "*":
+                num_asterisks += 1
+                is_asterisk = True
+            # The character is either a natural class or a single phoneme
+            symbol = environment[i + num_asterisks]
+            members = frozenset(phonemes[symbol]) if symbol in phonemes else frozenset([symbol])
+            checks.append((members, is_asterisk))
+        self.checks = tuple(checks)
+
+    # Returns whether the lexeme is in this environment, or None if the lexeme is shorter than the environment
+    def matches(self, lexeme):
+        # The lexeme has to be at least as long as the environment
+        if len(lexeme) < self.length:
+            return None
+        # The triggers are the sounds in the word that the environment looks at
+        triggers = lexeme[len(lexeme) - self.length:] if self.is_suffix else lexeme[:self.length]
+        # Every trigger must be in its natural class (or be its phoneme), unless the environment negates it
+        for trigger, (members, is_asterisk) in zip(triggers, self.checks):
+            if (trigger in members) == is_asterisk:
+                return False
+        return True
+
+
+# The allophonic environments of all the paradigms of a language, numbered so that the environments of a lexeme are
+#   described by a single integer mask: bit 2 * i is set if the lexeme is in environment i, and bit 2 * i + 1 is set if
+#   the lexeme is shorter than environment i
+# Masks for a whole list of lexemes are computed at once with NumPy, so the lexicon only pays for this once
+class EnvironmentSet:
+    __slots__ = ("phonemes", "environments", "ids", "_masks")
+
+    def __init__(self, phonemes):
+        self.phonemes = phonemes
+        self.environments = []
+        self.ids = {}
+        # Masks of the lexemes we've seen one at a time, e.g. forms that an earlier paradigm already inflected
+        self._masks = {}
+
+    # Get the index of an environment such as "eC_", adding it if it's new
+    def add(self, environment):
+        if environment not in self.ids:
+            self.ids[environment] = len(self.environments)
+            self.environments.append(PhonologicalEnvironment(environment, self.phonemes))
+            self._masks.clear()
+        return self.ids[environment]
+
+    # Get the mask of a single lexeme
+    def mask(self, lexeme):
+        mask = self._masks.get(lexeme)
+        if mask is None:
+            mask = 0
+            for i, environment in enumerate(self.environments):
+                match = environment.matches(lexeme)
+                if match is None:
+                    mask |= 2 << (2 * i)
+                elif match:
+                    mask |= 1 << (2 * i)
+            self._masks[lexeme] = mask
+        return mask
+
+    # Get the masks of a list of lexemes as an integer array
+    def masks(self, lexemes):
+        if not self.environments:
+            return np.zeros(len(lexemes), dtype=np.uint64)
+        # Masks are 64 bit integers, so we can only vectorize 32 environments
+        if len(self.environments) > 32:
+            return np.array([self.mask(lexeme) for lexeme in lexemes], dtype=object)
+        if not lexemes:
+            return np.zeros(0, dtype=np.uint64)
+        # Lay the lexemes out as a matrix of code points, one row per lexeme
+        forms = np.array(lexemes, dtype=str)
+        lengths = np.char.str_len(forms)
+        codes = forms.view(np.uint32).reshape(len(lexemes), -1)
+        rows = np.arange(len(lexemes))
+        masks = np.zeros(len(lexemes), dtype=np.uint64)
+        for i, environment in enumerate(self.environments):
+            too_short = lengths < environment.length
+            match = ~too_short
+            # Check every phoneme the environment looks at
+            for position, (members, is_asterisk) in enumerate(environment.checks):
+                columns = lengths - environment.length + position if environment.is_suffix else position
+                triggers = codes[rows, np.clip(columns, 0, codes.shape[1] - 1)]
+                # Multi character phonemes can't match a single character, so we leave them out
+                member_codes = [ord(member) for member in members if len(member) == 1]
+                match &= np.isin(triggers, member_codes) != is_asterisk
+            masks |= match.astype(np.uint64) << np.uint64(2 * i)
+            masks |= too_short.astype(np.uint64) << np.uint64(2 * i + 1)
+        return masks
+
+    # Describe the environments in a mask, for error messages
+    def describe(self, mask):
+        descriptions = []
+        for i, environment in enumerate(self.environments):
+            if (mask >> (2 * i)) & 3:
+                bits = (mask >> (2 * i)) & 3
+                descriptions.append(f"/{environment.environment}: " + ("too short" if bits == 2 else "True"))
+        return ", ".join(descriptions) or "none"
+
+
+# Materialized form of one inflection paradigm, ["w", {("p1", "p2", ...): "-s1", ...}]
+# Properties are bitsets of the features in the FeatureTable feature_table
+# Whether a key applies to a word only depends on two things:
+#   - which of the features mentioned in the keys the word has (its projection onto self.features, a bitset)
+#   - which of the allophonic environments mentioned in the keys the lexeme is in (its environment class)
+# So the applicable inflections are worked out once for every (projection, environment class) and then looked up
+# The environments are numbered in the language's EnvironmentSet. The environment class of a lexeme is its mask from
+#   the EnvironmentSet, keeping only the bits in self.environment_bits
+# index is the place of the paradigm in the language's inflection paradigms. Several paradigms can have the same
+#   trigger, so errors are counted by name, the trigger and the index (e.g. "adj#2"), see GenerationStats
+class InflectionTable:
+    __slots__ = ("trigger", "trigger_bit", "name", "paradigm", "feature_table", "features", "environment_set",
+                 "environment_bits", "keys", "table")
+
+    def __init__(self, paradigm, environment_set, feature_table, index=0):
+        self.trigger = paradigm[0]
+        self.name = f"{paradigm[0]}#{index}"
+        self.trigger_bit = feature_table.intern(paradigm[0])
+        self.paradigm = paradigm
+        self.feature_table = feature_table
+        self.environment_set = environment_set
+        features = 0
+        environment_bits = 0
+        keys = []
+        # rule_properties is a collection (or single) property that must apply for the inflection to be used
+        # inflection is the inflection that will be applied (e.g. "-suf" or "pref-")
+        for rule_properties, inflection in paradigm[1].items():
+            present, absent, environment_indices = [], [], []
+            # If the keys are tuples, then all properties must match
+            # If they're not, then only the single property must match
+            for rule_property in (rule_properties if type(rule_properties) == tuple else [rule_properties]):
+                # Allophonic properties look at the phonemes next to where the affix attaches
+                if rule_property[0] == "/":
+                    assert inflection[0] == "-" or inflection[-1] == "-"
+                    environment_index = environment_set.add(rule_property[1:])
+                    environment_indices.append(environment_index)
+                    environment_bits |= 3 << (2 * environment_index)
+                # Properties starting with an asterisk require a feature's absence
+                elif rule_property[0] == "*":
+                    absent.append(rule_property[1:])
+                # All other rule properties just require the property to exist in the lexeme's properties
+                else:
+                    present.append(rule_property)
+            present, absent = feature_table.bits(present), feature_table.bits(absent)
+            features |= present | absent
+            keys.append((present, absent, tuple(environment_indices), inflection))
+        self.features = features
+        self.environment_bits = environment_bits
+        self.keys = tuple(keys)
+        # Maps (projection, environment class) to the tuple of applicable inflections
+        self.table = {}
+
+    # Work out the applicable inflections for a projection and environment class, and store them in the table
+    # Returns the tuple of applicable inflections. If a key needs an environment that is longer than the lexeme,
+    #   None is returned instead, since the environment can't be checked
+    def resolve(self, projection, environment_class):
+        applicable_inflections = []
+        for present, absent, environment_indices, inflection in self.keys:
+            # Every present property must be there and every absent property must not be
+            if present & projection != present or absent & projection:
+                continue
+            # Every environment must match the lexeme
+            environment_bits = [(environment_class >> (2 * i)) & 3 for i in environment_indices]
+            if 2 in environment_bits:
+                applicable_inflections = None
+                break
+            if all(environment_bits):
+                applicable_inflections.append(inflection)
+        outcome = None if applicable_inflections is None else tuple(applicable_inflections)
+        self.table[(projection, environment_class)] = outcome
+        return outcome
+
+    # Fill in the table for every projection and environment class that the language can produce
+    # Returns a list of the combinations that don't give exactly one inflection, as (properties, environment class,
+    #   applicable inflections) tuples
+    def precompute(self, property_sets, environment_classes):
+        problems = []
+        for projection in {self.features & property_set for property_set in property_sets}:
+            for environment_class in environment_classes:
+                outcome = self.resolve(projection, environment_class)
+                if outcome is None or len(outcome) != 1:
+                    problems.append((projection, environment_class, outcome))
+        return problems
+
+    # Inflect a lexeme whose properties are the bitset property_set, and whose environment mask is environment_mask
+    def inflect(self, lexeme, property_set, environment_mask):
+        projection = self.features & property_set
+        environment_class = environment_mask & self.environment_bits
+        outcome = self.table.get((projection, environment_class))
+        if outcome is None:
+            outcome = self.resolve(projection, environment_class)
+        # Some key needs more phonemes than the lexeme has
+        if outcome is None:
+            raise GenerationError("environment_too_long", self.name, describe=lambda: (
+                f"Lexeme {lexeme} is shorter than an environment in rule {self.paradigm}. \n"
+                f"Debug info: properties = {sorted(self.feature_table.properties(property_set))}"))
+        # There should be exactly one key that works with the agreements of the lexeme
+        if len(outcome) != 1:
+            raise GenerationError("inflection_count", self.name, describe=lambda: (
+                f"Incorrect number of applicable inflections ({len(outcome)}) "
+                f"for {[lexeme, sorted(self.feature_table.properties(property_set))]} "
+                f"given rule {self.paradigm}. \n"
+                f"Debug info: properties = {sorted(self.feature_table.properties(property_set))}, "
+                f"applicable_inflections = {list(outcome)}"))
+        # The affixed form depends on the position of the dash.
+        # For simple affixes, we just attach it where the dash it
+        return outcome[0].replace("-", lexeme)
+
+
+# Inflect a single lexeme with a list of InflectionTables, which apply in order
+# property_set is the bitset of the lexeme's properties in the tables' FeatureTable
+# environment_mask is the lexeme's mask in environment_set, if it's already known
+def _inflect_lexeme(lexeme, property_set, inflection_tables, environment_set, environment_mask=None):
+    for table in inflection_tables:
+        # If the pos of a rule isn't in the lexeme, it doesn't apply
+        if table.trigger_bit & property_set:
+            if environment_mask is None:
+                environment_mask = environment_set.mask(lexeme)
+            inflected_lexeme = table.inflect(lexeme, property_set, environment_mask)
+            # If the form changed, the environments of the new form have to be worked out again
+            if inflected_lexeme != lexeme:
+                lexeme = inflected_lexeme
+                environment_mask = None
+    return lexeme
+
+
 # Method used to inflect the agreed_lexeme_sequences according to some rules
 # agreed_lexeme_sequences is a list of agreed_lexeme_sequences, paradigms is formatted as Language.inflection_paradigms
 def inflect(agreed_lexeme_sequences, paradigms, phonemes):
     # Make sure that a list of lists is passed in
     assert type(agreed_lexeme_sequences[0]) is list
+    # Materialize the paradigms, so that each inflection is a lookup
+    environment_set = EnvironmentSet(phonemes)
+    feature_table = FeatureTable()
+    inflection_tables = [InflectionTable(paradigm, environment_set, feature_table, index)
+                         for index, paradigm in enumerate(paradigms)]
     inflected_sentences = []
-    # For each agreed_lexeme_sequence, we want to run the agreement algorithm
     for agreed_lexeme_sequence in agreed_lexeme_sequences:
-        inflected_words = []
-        # Do agreement over each lexeme in the sequence
-        for lexeme_with_agreement in agreed_lexeme_sequence:
-            # Get the lexeme and the properties of the word
-            lexeme, properties = lexeme_with_agreement
-            # See if it agrees with any rules (can be 0, 1, or more)
-            # A for loop is used here since it's possible that more than one rule applies
-            for rule in paradigms:
-                # If the pos of a rule isn't in the lexeme, we continue
-                if rule[0] not in properties:
-                    continue
-                # Otherwise, the rule applies
-                # We want to see the number of applicable inflections, since it should be equal to exactly 1
-                applicable_inflections = []
-                # rule_properties is a collection (or single) property that must apply for the inflection to be used
-                # inflection is the inflection that will be applied (e.g. "-suf" or "pref-")
-                for rule_properties, inflection in rule[1].items():
-                    # We want to check that each property applies. If any don't we continue
-                    perfect_property_match = True
-                    # If the keys are tuples, then all properties must match
-                    # If they're not, then only the single property must match
-                    for rule_property in (rule_properties if type(rule_properties) == tuple else [rule_properties]):
-                        # If the rule property doesn't apply, then it's not a perfect match
-                        # This means we don't add the inflection to applicable inflections
-                        # If a rule property is allophonic, we handle it differently
-                        if rule_property[0] == "/":
-                            # Get the part after the slash
-                            environment = rule_property[1:]
-                            # Get the environment before and after the underscore
-                            left_environment, right_environment = environment.split("_")
-                            # We don't want circumfixes or environments that rely on right and left phonemes
-                            assert not (left_environment and right_environment)
-                            assert inflection[0] == "-" or inflection[-1] == "-"
-                            # If the inflection is "-suf", then we want to look at the phonemes to the left of the "-"
-                            # An example environment is "/C_"
-                            # If it's a suffix, it only has a left environment
-                            # We will want to look at the sounds before where the "-" would attach
-                            # The triggers are the sounds in the words
-                            # The environment is from the inputted property
-                            if left_environment:
-                                environment = left_environment
-                                triggers = lexeme[-len(environment.replace("*", "")):]
-                            # If it's a prefix, we want to look at the sounds after the "-"
-                            elif right_environment:
-                                environment = right_environment
-                                triggers = lexeme[:len(environment.replace("*", ""))]
-                            else:
-                                raise Exception("Unknown error! Neither left nor right environment.")
-                            # The triggers should be the same length as the environment without the *
-                            assert len(triggers) == len(environment.replace("*", ""))
-                            # We want to make sure that every phoneme on the left matches the environment
-                            num_asterisks = 0
-                            # We match every trigger, and compare it with the one or two characters in environment
-                            for i in range(len(triggers)):
-                                # The action we take depends on if the environment's character is a natural class,
-                                #   phoneme, or asterisk. If there is an asterisk, we negate
-                                is_asterisk = False
-                                # If it's an asterisk, we make sure the following character is negative
-                                if environment[i] == "*":
-                                    num_asterisks += 1
-                                    is_asterisk = True
-                                # The action we do depends on whether it's negated!
-                                # A is whether the trigger is in the environment, or the trigger is the environment
-                                # A = triggers[i] in phonemes[environment[i + num_asterisks]]  # (natural class)
-                                # A = triggers[i] != environment[i + num_asterisks]  # (phoneme)
-                                # We represent both of these with the variable match
-                                # B is whether the environment has an asterisk
-                                # B = is_asterisk
-                                # If there is no asterisk, then the trigger not being in the natural class breaks
-                                # B = false, A = false --> (execute and break) True
-                                # If there is no asterisk, then the trigger being in the natural class continues
-                                # B = false, A = true --> (do not execute) False
-                                # If there is an asterisk, then the trigger not being in the natural class continues
-                                # B = true, A = false --> (do not execute) False
-                                # If there is an asterisk, then the trigger being in the natural class breaks
-                                # B = true, A = true --> (execute and break) True
-                                # Find the appropriate A
-                                if environment[i + num_asterisks] in phonemes:
-                                    match = triggers[i] in phonemes[environment[i + num_asterisks]]
-                                else:
-                                    match = triggers[i] == environment[i + num_asterisks]
-                                # Now we do the logical operation described above
-                                # We want to enter this statement if the triggers don't match the environmnet
-                                if bool(match) == bool(is_asterisk):
-                                    perfect_property_match = False
-                                    break
-                        # If a rule property requires a feature's absence, we handle it differently
-                        elif rule_property[0] == "*":
-                            # We just want to make sure that this feature does not exist in the lexeme's properties
-                            if rule_property[1:] in properties:
-                                perfect_property_match = False
-                        # All other rule properties just require the property to exist in the lexeme's properties
-                        else:
-                            # This is the truth condition for non-allophonic properties to be true
-                            if rule_property not in properties:
-                                perfect_property_match = False
-                        # If it's not a perfect_property_match, we break the loop
-                        if not perfect_property_match:
-                            break
-                    # If it's not a perfect_property_match, we don't add this inflection to the applicable inflections
-                    # Instead, we continue the loop
-                    if not perfect_property_match:
-                        continue
-                    # If it's a perfect property match, we do indeed want to add it to the applicable inflections
-                    applicable_inflections.append(inflection)
-                # There should be exactly one key that works with the agreements of the lexeme
-                if len(applicable_inflections) != 1:
-                    raise Exception(f"Incorrect number of applicable inflections ({len(applicable_inflections)}) "
-                                    f"for {lexeme_with_agreement} "
-                                    f"given rule {rule}. \n"
-                                    f"Debug info: properties = {properties}, "
-                                    f"applicable_inflections = {applicable_inflections}")
-                # We apply the affix to the lexeme
-                affix = applicable_inflections[0]
-                # The affixed form depends on the position of the dash.
-                # For simple affixes, we just attach it where the dash it
-                lexeme = affix.replace("-", lexeme)
-            # Once we go through all the rules, we can add it to inflected words
-            # We add them with the properties in case we want to look at them
-            inflected_words.append([lexeme, properties])
-        # We now take the inflected words and turn them into the surface form
-        inflected_sentence = " ".join([word_and_properties[0] for word_and_properties in inflected_words])
-        # Add this to the inflected sentences
-        inflected_sentences.append(inflected_sentence)
+        # Inflect every lexeme and turn them into the surface form
+        inflected_sentences.append(" ".join(_inflect_lexeme(lexeme, feature_table.bits(properties), inflection_tables,
+                                                            environment_set)
+                                            for lexeme, properties in agreed_lexeme_sequence))
     # Return the inflected sentences
     return inflected_sentences
 
 
+# A word of a sentence while the sentence is being generated
+#   pos is its terminal part of speech and lexeme is its base form, once it's chosen
+#   features is the bitset of its properties in the grammar's FeatureTable
+#   phrases is the tuple of the ids of the phrases it's in, from the outermost to the innermost
+#   environment_mask is the lexeme's mask in the grammar's EnvironmentSet, or None if it isn't from the lexicon
+class Node:
+    __slots__ = ("pos", "lexeme", "features", "properties", "phrases", "environment_mask")
+
+    def __init__(self, pos, features, phrases):
+        self.pos = pos
+        self.lexeme = None
+        self.features = features
+        # The properties the word was derived with, before it has a lexeme
+        self.properties = features
+        self.phrases = phrases
+        self.environment_mask = None
+
+    # The word as [lexeme, properties], the way annotations show it
+    # Every phrase is written as a "__hash__:<phrase id>" property, the way the grammar marks it
+    def annotation(self, features):
+        return [self.lexeme, features.properties(self.features) + [f"__hash__:{phrase}" for phrase in self.phrases]]
+
+
+# Make sure that the output of generate_sentences is 'both', 'sentences', or 'annotations'
+def _check_output(output):
+    if output not in ['both', 'sentences', 'annotations']:
+        raise ValueError(f'Output {output} illegal.')
+
+
+# Collect the batches of Language.iter_sentences (or iter_sentence_shards) into what generate_sentences returns
+# Returns (sentences, agreed_lexeme_sequences), with None for whatever output doesn't keep
+def _collect_sentences(batches, output):
+    sentences = [] if output != 'annotations' else None
+    agreed_lexeme_sequences = [] if output != 'sentences' else None
+    for batch in batches:
+        if output == 'sentences':
+            sentences += batch
+            continue
+        batch_sentences, batch_sequences = batch
+        if sentences is not None:
+            sentences += batch_sentences
+        agreed_lexeme_sequences += batch_sequences
+    return sentences, agreed_lexeme_sequences
+
+
+# The language and the generation arguments of the shards a worker process generates
+_shard_worker_state = None
+
+
+# Runs once in every worker process of Language.iter_sentence_shards
+def _initialize_shard_worker(language, arguments):
+    global _shard_worker_state
+    _shard_worker_state = (language, arguments)
+
+
+# Generate one shard in a worker process
+def _generate_shard(shard):
+    language, arguments = _shard_worker_state
+    return language._generate_shard(*shard, *arguments)
+
+
 # Language class used to generate words according to a distribution
+# rng is where the language gets its random numbers from: None for the global random and numpy.random state, or a
+#   seed or numpy.random.Generator for a stream of its own (see random_source). A copied language shares the random
+#   number generator of the language it's copied from, unless it's given one
+# A copied language shares its fields with the language it's copied from, and whichever of them changes a field first
+#   copies it (see _own). This way variants of a language, e.g. from fork, only cost what they change. Fields must
+#   be changed with the set_* and add methods for this, not in place
 class Language:
     # Constructor
-    def __init__(self, language=None):
+    def __init__(self, language=None, rng=None):
         # All the fields depend on whether language is passed in
         # Maps C and V to a list of phonemes
-        self.phonemes = {} if language is None else deepcopy(language.phonemes)
-        self.syllables = [] if language is None else deepcopy(language.syllables)
-        self.syllable_lambda = 1 if language is None else deepcopy(language.syllable_lambda)
-        self.generation_rules = {} if language is None else deepcopy(language.generation_rules)
-        self.unconditioned_rules = {} if language is None else deepcopy(language.unconditioned_rules)
-        self.agreement_rules = {} if language is None else deepcopy(language.agreement_rules)
-        self.words = {} if language is None else deepcopy(language.words)
-        self.word_set = set() if language is None else deepcopy(language.word_set)
-        self.inflection_paradigms = [] if language is None else deepcopy(language.inflection_paradigms)
+        self.phonemes = {} if language is None else language.phonemes
+        self.syllables = [] if language is None else language.syllables
+        self.syllable_lambda = 1 if language is None else language.syllable_lambda
+        self.generation_rules = {} if language is None else language.generation_rules
+        self.unconditioned_rules = {} if language is None else language.unconditioned_rules
+        self.agreement_rules = {} if language is None else language.agreement_rules
+        self.words = {} if language is None else language.words
+        self.word_set = set() if language is None else language._word_set
+        self.inflection_paradigms = [] if language is None else language.inflection_paradigms
+        # The fields that are shared with other languages, and the parts of speech whose word lists are
+        self._shared = set()
+        self._shared_words = set()
+        if language is not None:
+            for shared_language in (self, language):
+                shared_language._shared.update(_SHARED_FIELDS)
+                shared_language._shared_words.update(self.words)
+        # The compiled grammar is immutable, so a copied language can share it until one of its rules changes
+        self._compiled = None if language is None else language._compiled
+        # Zipf samplers for each part of speech, only depending on the number of words and the skew
+        self._zipf_samplers = {} if language is None else dict(language._zipf_samplers)
+        self.rng = language.rng if language is not None and rng is None else random_source(rng)
+        # The WordFormSampler of generate_words, made when it's first needed
+        self._word_forms = None
+        # The depth up to which sentences are sampled from skeletons, see set_skeleton_depth
+        self.skeleton_depth = None if language is None else language.skeleton_depth
+        # The number of local retries a sentence gets, see set_retry_budget
+        self.retry_budget = 0 if language is None else language.retry_budget
+        # The bounds on the depth and length of derivations, see set_derivation_bounds
+        self.max_depth = None if language is None else language.max_depth
+        self.max_lengths = None if language is None else language.max_lengths
+
+    # Compile the generation and unconditioned rules into a CompiledGrammar, which sentence generation uses
+    # This also materializes the inflection paradigms into InflectionTables, and fills them in for every combination
+    #   of features and phonological environments that the grammar and lexicon can produce. Combinations that don't
+    #   give exactly one inflection are kept in inflection_problems of the result. If strict is True, an error is
+    #   raised instead
+    # The result is cached, and any set_* method throws the cache away, so this only does work after a change
+    def compile(self, strict=False):
+        if self._compiled is None:
+            grammar = CompiledGrammar(self.generation_rules, self.unconditioned_rules, self.words.keys())
+            grammar.compile_agreement_rules(self.agreement_rules)
+            grammar.environment_set = EnvironmentSet(self.phonemes)
+            grammar.inflection_tables = tuple(InflectionTable(paradigm, grammar.environment_set, grammar.features,
+                                                              index)
+                                              for index, paradigm in enumerate(self.inflection_paradigms))
+            # Work out the environments of every word in the lexicon once, one pos at a time
+            grammar.environment_masks = {pos: grammar.environment_set.masks([word for word, _ in words]).tolist()
+                                         for pos, words in self.words.items()}
+            grammar.inflection_problems = self._precompute_inflections(grammar)
+            self._compiled = grammar
+        if strict and self._compiled.inflection_problems:
+            raise ValueError("Inflection paradigms don't give exactly one inflection for:\n" + "\n".join(
+                f"{table.trigger}: properties {sorted(table.feature_table.properties(projection))}, "
+                f"environments ({table.environment_set.describe(environment_class)}), "
+                f"inflections {outcome}" for table, projection, environment_class, outcome
+                in self._compiled.inflection_problems))
+        return self._compiled
+
+    # Fill in the inflection tables of a grammar for every word that the language can generate
+    # The properties of a word are the ones it's derived with, its pos, its paradigm, and the properties it takes from
+    #   agreement. For agreement we take every word that has the required properties, so this covers a few words that
+    #   can never be in the same phrase, but never misses a word that can
+    # Returns a tuple of (table, projection, environment class, applicable inflections) for every problem
+    def _precompute_inflections(self, grammar):
+        if not grammar.inflection_tables:
+            return ()
+        # Start with the properties before agreement
+        word_properties = {}
+        for pos, property_sets in grammar.terminal_properties().items():
+            paradigms = {paradigm for _, paradigm in self.words[pos]}
+            word_properties[pos] = {property_set | {pos} | set(paradigm.split("."))
+                                    for property_set in property_sets for paradigm in paradigms}
+        all_properties = set().union(*word_properties.values())
+        # Find the properties that each agreement rule can add
+        agreement_outcomes = {}
+        for agreeing_property, (required_properties, sought_features) in self.agreement_rules.items():
+            required_properties = set(required_properties) - {"__hash__"}
+            outcomes = set()
+            for property_set in all_properties:
+                if not required_properties <= property_set:
+                    continue
+                new_properties = [set(sought_feature) & property_set for sought_feature in sought_features]
+                # Words that don't have exactly one of each feature make agreement fail, not inflection
+                if all(len(new_property) == 1 for new_property in new_properties):
+                    outcomes.add(frozenset().union(*new_properties))
+            agreement_outcomes[agreeing_property] = outcomes
+        # Add the agreement properties to every word that agrees
+        for pos, property_sets in word_properties.items():
+            agreed_property_sets = set()
+            for property_set in property_sets:
+                agreeing_properties = [prop for prop in property_set if prop in agreement_outcomes]
+                if len(agreeing_properties) != 1:
+                    agreed_property_sets.add(property_set)
+                    continue
+                agreed_property_sets.update(property_set | outcome
+                                            for outcome in agreement_outcomes[agreeing_properties[0]])
+            word_properties[pos] = agreed_property_sets
+        # Fill in each table with the words it applies to
+        problems = []
+        for table in grammar.inflection_tables:
+            property_sets = []
+            environment_classes = set()
+            for pos, pos_property_sets in word_properties.items():
+                pos_property_sets = [property_set for property_set in pos_property_sets
+                                     if table.trigger in property_set]
+                if not pos_property_sets:
+                    continue
+                property_sets += pos_property_sets
+                # We check the environments of the lexemes before they are inflected
+                environment_classes.update(np.unique(np.array(grammar.environment_masks[pos], dtype=object)
+                                                     & table.environment_bits).tolist())
+            property_sets = [grammar.features.bits(property_set) for property_set in property_sets]
+            problems += [(table, projection, environment_class, outcome) for projection, environment_class, outcome
+                         in table.precompute(property_sets, environment_classes)]
+        return tuple(problems)
+
+    # Make a variant of this language that shares everything it doesn't change with this one
+    # changes are the arguments of set_* methods by the name of the method without "set_", e.g.
+    #   language.fork(generation_rules={"VP": [["UnmarkedNP", "verb"], 1]}) for objects before verbs
+    # rng is the random number generator of the variant, by default the one of this language
+    def fork(self, rng=None, **changes):
+        variant = Language(self, rng=rng)
+        for name, value in changes.items():
+            setter = getattr(variant, f"set_{name}", None)
+            if setter is None:
+                raise ValueError(f"Languages don't have a set_{name} method.")
+            setter(value)
+        return variant
+
+    # Get a field to change in place, first copying it if it's shared with another language
+    # Copies are shallow, since the values in the fields are replaced rather than changed
+    def _own(self, name):
+        value = getattr(self, name)
+        if name in self._shared:
+            value = copy(value)
+            setattr(self, name, value)
+            self._shared.discard(name)
+        return value
+
+    # Get the word list of a part of speech to change in place, first copying it if it's shared with another language
+    def _own_words(self, part_of_speech):
+        words = self._own("words")
+        if part_of_speech in self._shared_words:
+            words[part_of_speech] = copy(words[part_of_speech])
+            self._shared_words.discard(part_of_speech)
+            # The compiled grammar gets the environment masks of new words (see _environment_masks), so the masks of
+            #   this pos are copied along with the words
+            if self._compiled is not None and part_of_speech in self._compiled.environment_masks:
+                self._compiled = copy(self._compiled)
+                self._compiled.environment_masks = dict(self._compiled.environment_masks)
+                self._compiled.environment_masks[part_of_speech] = list(
+                    self._compiled.environment_masks[part_of_speech])
+        return words[part_of_speech]
+
+    # Sample sentences from the skeletons of the grammar up to skeleton_depth expansions below the start state, or
+    #   expand the grammar for every sentence if it's None. See CompiledGrammar.skeletons
+    # Skeletons give sentences with the same distribution, only drawing the words and deeper expansions per sentence,
+    #   and their agreement links and inflection slots are worked out once. They use the random numbers differently,
+    #   so the same seed gives different sentences
+    def set_skeleton_depth(self, skeleton_depth=None):
+        assert skeleton_depth is None or (type(skeleton_depth) is int and skeleton_depth >= 0)
+        self.skeleton_depth = skeleton_depth
+
+    # Set the number of local retries each sentence gets when agreement or inflection fails
+    # A retry draws the innermost phrase of the word that caused the error again (or the word itself, if it isn't in
+    #   a phrase), instead of the whole sentence. This conditions phrases on working out, so it changes the
+    #   distribution of sentences that would otherwise fail. Once the budget is used up, the error is raised as usual
+    # Retries draw more random numbers, so the sentences after a retry differ from the ones without retries
+    def set_retry_budget(self, retry_budget=0):
+        assert type(retry_budget) is int and retry_budget >= 0
+        self.retry_budget = retry_budget
+
+    # Bound the derivations of sentences to at most max_depth expansions below the start state (counted like for
+    #   set_skeleton_depth), and at most max_length words
+    # max_length is either a number of words, or a dictionary from numbers of words to their probabilities, in which
+    #   case every sentence is bounded by a length drawn from it. Lengths below the shortest sentence the grammar has
+    #   within max_depth are raised to it. Either bound is None to leave it out
+    # The bounds are kept while the grammar is expanded: a rule only chooses among the alternatives that can still
+    #   finish within them, with their probabilities renormalized. Sentences are never thrown away for being too long,
+    #   and the time a sentence takes is bounded. Rules that don't come close to the bounds choose as usual
+    # Skeletons aren't used while there are bounds, and drawing lengths uses random numbers, so the same seed gives
+    #   different sentences
+    def set_derivation_bounds(self, max_depth=None, max_length=None):
+        assert max_depth is None or (type(max_depth) is int and max_depth >= 0)
+        self.max_depth = max_depth
+        if max_length is None:
+            self.max_lengths = None
+        # The lengths are kept with their cumulative probabilities, so drawing one is a bisect
+        else:
+            if type(max_length) is not dict:
+                max_length = {max_length: 1}
+            assert all(type(length) is int and length > 0 for length in max_length)
+            lengths = tuple(max_length)
+            cumulative = tuple(accumulate(max_length[length] for length in lengths))
+            if not cumulative[-1] > 0:
+                raise ValueError("The probabilities of max_length must sum to more than zero.")
+            self.max_lengths = (lengths, cumulative)
+
+    # Set where the language gets its random numbers from, see the Language class
+    def set_rng(self, rng):
+        self.rng = random_source(rng)
 
     # Set the phonemes
     def set_phonemes(self, phonemes):
         self.phonemes = phonemes
+        self._compiled = None
+        self._word_forms = None
 
     # Set the syllables
     def set_syllables(self, syllables):
         self.syllables = syllables
+        self._compiled = None
+        self._word_forms = None
 
     # Set the lambda for the number of syllables in the language. The number is automatically summed to 1.
     def set_syllable_lambda(self, syllable_lambda=1):
         self.syllable_lambda = syllable_lambda
+        self._compiled = None
+        self._word_forms = None
 
     # Set part of speech
     # Not encoded in a separate variable
@@ -230,8 +1974,12 @@ class Language:
         # The parts of speech passed in must be in the form of a list
         assert type(parts_of_speech) is list
         # For each part of speech, define the words belonging to that part of speech as an empty list
+        words = self._own("words")
         for part_of_speech in parts_of_speech:
-            self.words[part_of_speech] = []
+            words[part_of_speech] = []
+            self._shared_words.discard(part_of_speech)
+        # New parts of speech are new terminal states
+        self._compiled = None
 
     # Set sentence generation rules according to CFGs
     # The format of a rule is "A": [["B", "C*p", "..."], x, ["D"], y, ...]
@@ -246,7 +1994,8 @@ class Language:
     #   This means verb phrases take an object noun with probability 0.7
     # The probabilities must sum to 1, but this isn't checked
     def set_generation_rules(self, generation_rules):
-        self.generation_rules.update(generation_rules)
+        self._own("generation_rules").update(generation_rules)
+        self._compiled = None
 
     # Sets sentence generation rules for individual words that are not conditioned by other words
     # The format of a rule is "A": [["a"], "p1", x, "p2", y, ...]
@@ -256,7 +2005,8 @@ class Language:
     # An example is "sN": [["noun"], "sing", 0.8, "pl", 0.2]
     #   This means that subject nouns map to nouns, with the feature singular with probability 0.8 and plural with 0.2
     def set_unconditioned_rules(self, unconditioned_rules):
-        self.unconditioned_rules.update(unconditioned_rules)
+        self._own("unconditioned_rules").update(unconditioned_rules)
+        self._compiled = None
 
     # Sets the agreement rules for words with a property or terminal
     # The format of a rule is "t": [["p1", "p2", ...], [["q1", "q2", ...], ["r1", ...], ...]]
@@ -274,7 +2024,8 @@ class Language:
     # The agreement rules don't dictate the inflections, just what words agree with what
     # FOR NOW, WORDS CAN ONLY AGREE WITH ONE OTHER WORD. POTENTIALLY CHANGE THIS LATER.
     def set_agreement_rules(self, agreement_rules):
-        self.agreement_rules.update(agreement_rules)
+        self._own("agreement_rules").update(agreement_rules)
+        self._compiled = None
 
     # Allows you to pass in a custom vocabulary
     # The vocabulary is a dict of the following format:
@@ -301,24 +2052,14 @@ class Language:
     #   to separate multiple features. Assigning a pos key to a list is an abbreviation for creating a single paradigm
     #   called f'{pos}_main'
     # FOR NOW, IF A WORD IS MULTIPLE PARTS OF SPEECH IT WILL ONLY KEEP THE FIRST
+    # imported_dictionary can also be a Lexicon, e.g. from load_lexicon, which saves reading it again for every language
     def set_dictionary(self, imported_dictionary):
-        # Iterate through the words in the dictionary and add them to the lexicon
-        for pos, lexemes_or_classes in imported_dictionary.items():
-            # If it's just a list, then we add every word to the lexicon
-            if type(lexemes_or_classes) is list:
-                # Add each of the words to the lexicon
-                for lexeme in lexemes_or_classes:
-                    self.add_word(lexeme, pos, f'{pos}_main')
-            # Otherwise, we also need to add the features
-            elif type(lexemes_or_classes) is dict:
-                # We do the same for each class in the pos
-                for word_class in lexemes_or_classes:
-                    # Add each of the words to the lexicon
-                    for lexeme in lexemes_or_classes[word_class]:
-                        self.add_word(lexeme, pos, word_class)
-            # We shouldn't get here
-            else:
-                raise Exception("Values for parts of speech not lists or dictionaries")
+        lexicon = imported_dictionary if isinstance(imported_dictionary, Lexicon) else Lexicon(imported_dictionary)
+        # Add the words of every pos to the lexicon at once
+        for pos in lexicon.parts_of_speech:
+            self._own_words(pos).extend(lexicon.words(pos))
+        self._own("word_set").update(lexicon.word_set)
+        self._compiled = None
 
     # Define an inflection pattern for a given paradigm
     # The format of a rule is ["w", {("p1", "p2", ...): "-s1", ("q1", ...): "-s2", ...}]
@@ -339,14 +2080,15 @@ class Language:
     #       plural takes the suffix "-ol"
     def set_inflection_paradigms(self, inflection_paradigms):
         # The inflection_paradigm is a dictionary. All inflections are suffixes
-        self.inflection_paradigms.extend(inflection_paradigms)
+        self._own("inflection_paradigms").extend(inflection_paradigms)
+        self._compiled = None
 
     # Add words to our lexicon at the end of the list for that part of speech, but control for the surface form
     def add_word(self, surface_form, part_of_speech, paradigm):
         # Add the word to the language's word
-        self.words[part_of_speech].append((surface_form, paradigm))
+        self._own_words(part_of_speech).append((surface_form, paradigm))
         # Add the word to the language's word_set
-        self.word_set.add(surface_form)
+        self._own("word_set").add(surface_form)
 
     # Add words to our lexicon at the end of the list for that part of speech
     # Words can be individual words or tuples consisting of (word, paradigm_number)
@@ -354,34 +2096,712 @@ class Language:
     # Returns a list containing the new words
     # If you want to include more than one property in the paradigm, separate them with periods
     # New words are guaranteed to be not in wordset
-    def generate_words(self, num_words, part_of_speech, paradigm, add_to_lexicon=True):
+    # rng overrides the random number generator of the language for this call
+    def generate_words(self, num_words, part_of_speech, paradigm, add_to_lexicon=True, rng=None):
+        rng = self.rng if rng is None else random_source(rng)
         # Generate words with each phoneme in a given class appearing with the same frequency
         # All syllable types appear with equal frequency too
-        # We use a while loop since we don't want duplicate words (for now!)
-        new_words = []
-        while len(new_words) < num_words:
-            # Select a random number of syllables (+1 for non-empty syllables)
-            num_syllables = nprand.poisson(self.syllable_lambda) + 1
-            # For every syllable, choose a random syllable structure and construct a word out of it
-            word = ""
-            for syllable in range(num_syllables):
-                syllable_structure = random.choice(self.syllables)
-                # For every natural class in the syllable, choose a random phoneme that fits that description
-                for natural_class in syllable_structure:
-                    # Find a random phoneme from that natural class and add it to the word
-                    word += (nprand.choice(self.phonemes[natural_class]))
-            # If we generated a new word, we add it to our lexicon and to the words we made
-            if word not in self.word_set:
-                new_words.append((word, paradigm))
-                # We only add a new word to this language if add_to_lexicon is True
-                if add_to_lexicon:
-                    self.word_set.add(word)
-        # Add the new_words to the part of speech they were made for, if add_to_lexicon is True
+        # We don't want duplicate words (for now!), so the words are sampled without replacement from the forms that
+        #   aren't in the lexicon yet. See WordFormSampler
+        if self._word_forms is None:
+            self._word_forms = WordFormSampler(self.phonemes, self.syllables, self.syllable_lambda)
+        new_words = [(word, paradigm) for word in self._word_forms.sample(num_words, self.word_set, rng)]
+        # Add the new_words to the lexicon and the part of speech they were made for, if add_to_lexicon is True
         if add_to_lexicon:
-            self.words[part_of_speech] += new_words
+            self._own("word_set").update(word for word, _ in new_words)
+            self._own_words(part_of_speech).extend(new_words)
         # Now return the list in case it's needed
         return new_words
 
+    # Get the environment masks of the words of a part of speech from a compiled grammar
+    # Words added after compiling, e.g. with add_word, get their masks added here
+    def _environment_masks(self, grammar, part_of_speech):
+        masks = grammar.environment_masks.setdefault(part_of_speech, [])
+        words = self.words[part_of_speech]
+        if len(masks) < len(words):
+            masks += grammar.environment_set.masks([word for word, _ in words[len(masks):]]).tolist()
+        return masks
+
+    # Get the Zipf sampler for a part of speech, rebuilding it if the number of words or the skew changed
+    def _zipf_sampler(self, part_of_speech, skew):
+        sampler = self._zipf_samplers.get(part_of_speech)
+        if sampler is None or sampler.size != len(self.words[part_of_speech]) or sampler.skew != skew:
+            sampler = ZipfSampler(len(self.words[part_of_speech]), skew)
+            self._zipf_samplers[part_of_speech] = sampler
+        return sampler
+
+    # Expand the start state until only terminal parts of speech are left
+    # Returns a list of Nodes in sentence order, without their lexemes
+    # Every "__hash__" that an unconditioned rule adds opens a new phrase. Phrases are numbered from 0 in the order
+    #   they're opened, so ids are only unique within a sentence
+    # The partial derivation is kept on a stack of (state id, properties, phrases), with the leftmost state on top
+    #   This way every state is expanded exactly once, and terminals come off the stack in the order of the sentence
+    #   Properties are bitsets, so removing properties is a single mask
+    # If roots is a dictionary, the phrases that a local retry can draw again are added to it, see _resample_phrase
+    def _derive(self, grammar, rng, roots=None):
+        terminals = []
+        self._expand(grammar, [(grammar.state_ids["S"], 0, ())], 0, terminals, rng, roots)
+        return terminals
+
+    # Expand the states on a stack like _derive does, appending the Nodes of the terminals to terminals
+    # New phrases are numbered from next_phrase on, and the number after the last one is returned
+    # If roots is a dictionary, every new phrase is added to it, see _resample_phrase
+    def _expand(self, grammar, stack, next_phrase, terminals, rng, roots=None):
+        # The phrases whose states are still being expanded, with the size of the stack once they're done
+        open_phrases = []
+        while stack:
+            while open_phrases and len(stack) <= open_phrases[-1][1]:
+                roots[open_phrases.pop()[0]][2] = len(terminals)
+            state_id, properties, phrases = stack.pop()
+            kind = grammar.kinds[state_id]
+            # Terminal parts of speech are done
+            if kind == _TERMINAL:
+                terminals.append(Node(grammar.state_names[state_id], properties, phrases))
+            # If it's a generation rule, then we push each of the next states with the parent's properties
+            elif kind == _GENERATION:
+                # We push the children right to left, so that the leftmost child is expanded next
+                for next_state_id, kept_properties, leaves_phrases in reversed(grammar.choose(state_id, rng)):
+                    # Remove the properties after * for this next state only, if applicable
+                    # If the unwanted property is "__hash__", the next state isn't in any of the parent's phrases
+                    stack.append((next_state_id, properties & kept_properties, () if leaves_phrases else phrases))
+            # If it's an unconditioned rule, we add the chosen properties and move to the next state
+            elif kind == _UNCONDITIONED:
+                new_properties, opens_phrase = grammar.choose(state_id, rng)
+                # If the new properties have "__hash__", the next state is in a new phrase
+                if opens_phrase:
+                    if roots is not None:
+                        roots[next_phrase] = [(state_id, properties, phrases), len(terminals), None]
+                        open_phrases.append((next_phrase, len(stack)))
+                    phrases += (next_phrase,)
+                    next_phrase += 1
+                stack.append((grammar.next_states[state_id], properties | new_properties, phrases))
+            # Sanity check: the state should be a terminal, or in either generation or unconditioned
+            else:
+                state_name = grammar.state_names[state_id]
+                raise GenerationError("undefined_state", state_name, describe=lambda: (
+                    f"Invalid state {state_name}. \n"
+                    f"Make sure this is a key in generation or unconditioned rules."))
+        for phrase, _ in open_phrases:
+            roots[phrase][2] = len(terminals)
+        return next_phrase
+
+    # Derive a sentence like _derive, within the bounds of set_derivation_bounds
+    # max_length is the most words the sentence can have, and may be infinite
+    def _derive_bounded(self, grammar, rng, max_length, roots=None):
+        terminals = []
+        self._expand_bounded(grammar, [(grammar.state_ids["S"], 0, (), 0)], 0, terminals, rng, self.max_depth,
+                             max_length, roots)
+        return terminals
+
+    # Expand the states on a stack like _expand, with the depth of every state added to its stack entry
+    # Generation rules only choose alternatives that finish within max_depth expansions of the start state (None for no
+    #   bound) and within max_length words of the terminals this expansion adds, see CompiledGrammar.choose_bounded
+    # The words a state on the stack will give are at least the fewest it has within the expansions it has left, so a
+    #   rule can use what the rest of the stack leaves. Both bounds are met together, since an alternative's children
+    #   are measured with the expansions they'll have left
+    def _expand_bounded(self, grammar, stack, next_phrase, terminals, rng, max_depth, max_length, roots=None):
+        # The fewest words of every state and of the alternatives of every rule within the expansions left at depth, or
+        #   min_lengths and alternative_lengths without a depth bound
+        depth_lengths = None if max_depth is None else grammar.lengths_within(max_depth)
+
+        def lengths_at(depth):
+            if depth_lengths is None:
+                return grammar.min_lengths, grammar.alternative_lengths
+            return depth_lengths[max_depth - depth]
+
+        max_length += len(terminals)
+        pending_length = sum(lengths_at(depth)[0][state_id] for state_id, _, _, depth in stack)
+        open_phrases = []
+        while stack:
+            while open_phrases and len(stack) <= open_phrases[-1][1]:
+                roots[open_phrases.pop()[0]][2] = len(terminals)
+            state_id, properties, phrases, depth = stack.pop()
+            pending_length -= lengths_at(depth)[0][state_id]
+            kind = grammar.kinds[state_id]
+            if kind == _TERMINAL:
+                terminals.append(Node(grammar.state_names[state_id], properties, phrases))
+            elif kind == _GENERATION:
+                alternative = grammar.choose_bounded(state_id, rng, lengths_at(depth)[1][state_id],
+                                                     max_length - len(terminals) - pending_length)
+                child_lengths = lengths_at(depth + 1)[0]
+                for next_state_id, kept_properties, leaves_phrases in reversed(alternative):
+                    stack.append((next_state_id, properties & kept_properties, () if leaves_phrases else phrases,
+                                  depth + 1))
+                    pending_length += child_lengths[next_state_id]
+            elif kind == _UNCONDITIONED:
+                new_properties, opens_phrase = grammar.choose(state_id, rng)
+                if opens_phrase:
+                    if roots is not None:
+                        roots[next_phrase] = [(state_id, properties, phrases, depth), len(terminals), None]
+                        open_phrases.append((next_phrase, len(stack)))
+                    phrases += (next_phrase,)
+                    next_phrase += 1
+                next_state_id = grammar.next_states[state_id]
+                stack.append((next_state_id, properties | new_properties, phrases, depth + 1))
+                pending_length += lengths_at(depth + 1)[0][next_state_id]
+            # Undefined states can't finish, so they're only reached if the start state is one
+            else:
+                state_name = grammar.state_names[state_id]
+                raise GenerationError("undefined_state", state_name, describe=lambda: (
+                    f"Invalid state {state_name}. \n"
+                    f"Make sure this is a key in generation or unconditioned rules."))
+        for phrase, _ in open_phrases:
+            roots[phrase][2] = len(terminals)
+        return next_phrase
+
+    # Draw the most words a sentence can have from the max_length of set_derivation_bounds, or infinity if there's
+    #   no bound. It's never less than the fewest words a sentence of the grammar has within max_depth
+    def _draw_max_length(self, grammar, rng):
+        if self.max_lengths is None:
+            return float("inf")
+        lengths, cumulative = self.max_lengths
+        if len(lengths) == 1:
+            max_length = lengths[0]
+        else:
+            max_length = lengths[bisect(cumulative, rng.random() * cumulative[-1], 0, len(cumulative) - 1)]
+        return max(max_length, self._fewest_words(grammar))
+
+    # The fewest words a sentence of the grammar has within the max_depth of set_derivation_bounds
+    def _fewest_words(self, grammar):
+        if self.max_depth is None:
+            return grammar.min_lengths[grammar.state_ids["S"]]
+        return grammar.lengths_within(self.max_depth)[self.max_depth][0][grammar.state_ids["S"]]
+
+    # Build the SkeletonTable of set_skeleton_depth before any sentence is generated, if it's used
+    # This way a depth with too many derivations raises its error once, instead of failing every sentence
+    def _prepare_skeletons(self, grammar):
+        if self.skeleton_depth is not None and self.max_depth is None and self.max_lengths is None:
+            grammar.skeletons(self.skeleton_depth)
+
+    # Make sure the grammar can give sentences within the bounds of set_derivation_bounds
+    def _check_derivation_bounds(self, grammar):
+        start = grammar.state_ids["S"]
+        if self.max_depth is not None and grammar.min_depths[start] > self.max_depth:
+            raise ValueError(f"The grammar has no sentences within {self.max_depth} expansions. The shortest "
+                             f"derivations have {grammar.min_depths[start]}.")
+        if (self.max_depth is not None or self.max_lengths is not None) and self._fewest_words(grammar) == float("inf"):
+            raise ValueError("The grammar has no sentences that finish.")
+
+    # Turn a Skeleton into a list of Nodes in sentence order, without their lexemes
+    # The states of the skeleton past its depth bound are expanded as usual, in new phrases after the skeleton's
+    # If roots is a dictionary, the phrases of the sentence are added to it, like in _derive
+    def _derive_skeleton(self, grammar, skeleton, rng, roots=None):
+        terminals = []
+        next_phrase = skeleton.num_phrases
+        # Where the words of every item start
+        starts = []
+        for state_id, properties, phrases in skeleton.items:
+            starts.append(len(terminals))
+            if grammar.kinds[state_id] == _TERMINAL:
+                terminals.append(Node(grammar.state_names[state_id], properties, phrases))
+            else:
+                next_phrase = self._expand(grammar, [(state_id, properties, phrases)], next_phrase, terminals, rng,
+                                           roots)
+        if roots is not None:
+            starts.append(len(terminals))
+            for phrase, root, start, stop in skeleton.roots:
+                roots[phrase] = [root, starts[start], starts[stop]]
+        return terminals
+
+    # Draw a phrase of a sentence again, for a local retry
+    # roots maps the phrases of the sentence that can be drawn again to [root, start, stop], where root is the stack
+    #   entry of the unconditioned state that opened the phrase and nodes[start:stop] are its words
+    # The new words replace the old ones in nodes, and roots is updated to match. The new phrases are numbered from
+    #   next_phrase on, and the number after the last one is returned
+    # If max_length isn't None, the sentence was derived with _derive_bounded, and the phrase is drawn within the same
+    #   bounds, so it has at most the words the rest of the sentence leaves of max_length
+    def _resample_phrase(self, grammar, nodes, roots, phrase, next_phrase, required_words, sampling_method, zipf_skew,
+                         rng, max_length=None):
+        root, start, stop = roots[phrase]
+        new_roots = {}
+        new_nodes = []
+        if max_length is None:
+            next_phrase = self._expand(grammar, [root], next_phrase, new_nodes, rng, new_roots)
+        else:
+            next_phrase = self._expand_bounded(grammar, [root], next_phrase, new_nodes, rng, self.max_depth,
+                                               max_length - len(nodes) + stop - start, new_roots)
+        for node in new_nodes:
+            self._choose_word(grammar, node, required_words, sampling_method, zipf_skew, rng)
+        nodes[start:stop] = new_nodes
+        # The phrases inside the old phrase are gone, and the ones after or around it move with its end
+        # Phrases are opened before the phrases inside them, so those have the same or a larger id
+        shift = len(new_nodes) - (stop - start)
+        for other_phrase, span in list(roots.items()):
+            if other_phrase >= phrase and start <= span[1] and span[2] <= stop:
+                del roots[other_phrase]
+            elif span[1] >= stop:
+                span[1] += shift
+                span[2] += shift
+            elif span[2] >= stop:
+                span[2] += shift
+        for new_phrase, (new_root, new_start, new_stop) in new_roots.items():
+            roots[new_phrase] = [new_root, new_start + start, new_stop + start]
+        return next_phrase
+
+    # Index the words of a sentence by the agreement requirements they meet
+    # Maps (requirement id, None) to the positions of every word with the required properties, and for requirements
+    #   with "__hash__", (requirement id, phrase id) to the positions of those words that are in that phrase
+    # The positions are in sentence order
+    def _index_controllers(self, grammar, nodes):
+        index = {}
+        for requirement_id, (required_properties, needs_hash) in enumerate(grammar.agreement_requirements):
+            for position, node in enumerate(nodes):
+                if node.features & required_properties != required_properties:
+                    continue
+                index.setdefault((requirement_id, None), []).append(position)
+                if needs_hash:
+                    for phrase in node.phrases:
+                        index.setdefault((requirement_id, phrase), []).append(position)
+        return index
+
+    # Add the properties every word takes from agreement to its features
+    # nodes is the list of Nodes of a sentence, with their lexemes. They are updated in place
+    # Instead of checking every word against every other word, the sentence is indexed once by the requirements of the
+    #   agreement rules, so every word that agrees only looks at the words that can trigger its agreement
+    def _agree(self, grammar, nodes):
+        agreement_rules = grammar.agreement_rules
+        # The index is only built if some word in the sentence agrees
+        controllers = None
+        # Words agree with the properties the other words have before agreement, so we only update them at the end
+        agreed_features = []
+        for position, node in enumerate(nodes):
+            # Check to see if there's a rule describing this word.
+            # If there isn't, our work is done, so we continue
+            agreement_properties = node.features & grammar.agreement_triggers
+            if not agreement_properties:
+                continue
+            # For now, we can only handle one agreement. We might change this later
+            if agreement_properties & (agreement_properties - 1):
+                triggers = grammar.features.properties(agreement_properties)
+                raise GenerationError("multiple_agreements", ".".join(triggers), position, describe=lambda: (
+                    f"{node.annotation(grammar.features)} takes more than one agreement: {triggers}"))
+            rule, requirement_id, sought_features = agreement_rules[agreement_properties]
+            if controllers is None:
+                controllers = self._index_controllers(grammar, nodes)
+            # For __hash__, the word triggering agreement must be in every phrase this word is in
+            # E.g. in NP --> det NOM, the det must agree with the noun of the same NP. The word triggering agreement
+            #   is usually the head of the phrase, and may be in more phrases than this word, but never fewer
+            # We look the word up by its innermost phrase, which has the fewest words, and check the others
+            phrases = node.phrases
+            if grammar.agreement_requirements[requirement_id][1] and phrases:
+                candidates = controllers.get((requirement_id, phrases[-1]), ())
+                candidates = [candidate for candidate in candidates if set(phrases).issubset(nodes[candidate].phrases)]
+            else:
+                candidates = controllers.get((requirement_id, None), ())
+            words_triggering_agreement = [nodes[candidate] for candidate in candidates]
+            # Now we make sure there's EXACTLY ONE word triggering agreement
+            # A local retry draws the phrase of this word again, see GenerationError
+            # The message is only put together if it's printed, since it lists every word of the sentence
+            if len(words_triggering_agreement) != 1:
+                features = grammar.features
+                raise GenerationError("agreement_controllers", features.properties(agreement_properties)[0],
+                                      position, phrases[-1] if phrases else None, lambda: (
+                    f"{len(words_triggering_agreement)} words triggered agreement for "
+                    f"{node.annotation(features)}. These words are "
+                    f"{[word.annotation(features) for word in words_triggering_agreement]}. "
+                    f"The rule that triggered it is {rule}. "
+                    f"Check rules. \n"
+                    f"Preagreement lexemes: {[word.annotation(features) for word in nodes]}"))
+            # The word triggering agreement must have exactly one property of each feature this word seeks
+            word_triggering_agreement = words_triggering_agreement[0]
+            controller = candidates[0]
+            new_properties = 0
+            for sought_feature, sought_properties in sought_features:
+                property_intersection = sought_properties & word_triggering_agreement.features
+                # If there isn't exactly 1, then raise an error
+                # A local retry draws the phrase of the word triggering agreement again, since it lacks the feature
+                if not property_intersection or property_intersection & (property_intersection - 1):
+                    raise GenerationError("agreement_feature", grammar.features.properties(agreement_properties)[0],
+                                          controller, word_triggering_agreement.phrases[-1]
+                                          if word_triggering_agreement.phrases else None, lambda: (
+                        f"Incorrect number of properties found for "
+                        f"{node.annotation(grammar.features)}. \n"
+                        f"Sought feature: {sought_feature}. \n"
+                        f"Word triggering agreement: "
+                        f"{word_triggering_agreement.annotation(grammar.features)}"))
+                new_properties |= property_intersection
+            agreed_features.append((node, new_properties))
+        # All that is left is to add the new properties to the words that agree
+        for node, new_properties in agreed_features:
+            node.features |= new_properties
+
+    # Add the properties every word takes from agreement to its features, with the links of a Skeleton
+    # Only for skeletons whose links can be used, see Skeleton. If agreement fails, _agree raises the error
+    def _agree_skeleton(self, grammar, skeleton, nodes):
+        if skeleton.links is None:
+            return self._agree(grammar, nodes)
+        agreed_features = []
+        for position, controller, sought_features in skeleton.links:
+            controller_features = nodes[controller].features
+            new_properties = 0
+            for _, sought_properties in sought_features:
+                property_intersection = sought_properties & controller_features
+                # The error message comes from _agree
+                if not property_intersection or property_intersection & (property_intersection - 1):
+                    return self._agree(grammar, nodes)
+                new_properties |= property_intersection
+            agreed_features.append((nodes[position], new_properties))
+        for node, new_properties in agreed_features:
+            node.features |= new_properties
+
+    # Generate a single sentence with a compiled grammar, drawing from the RandomSource rng
+    # Returns the surface form and the list of its agreed Nodes, and raises an exception if generation fails
+    # The errors that local retries draw phrases again for are counted in stats, if it isn't None
+    # If profile is a GenerationProfile, the time of each stage is added to it. It's usually the same as stats
+    def _generate_sentence(self, grammar, required_words, sampling_method, zipf_skew, rng, stats=None, profile=None):
+        # The phrases a local retry can draw again, which we only keep track of if there are retries
+        roots = {} if self.retry_budget else None
+        if profile is not None:
+            profile.start()
+
+        # GENERATE THE TERMINAL POS STATES AND PROPERTIES
+        # We get a list of Nodes in sentence order, either by expanding the grammar or from a skeleton
+        # With bounds on the derivation, the grammar is always expanded, see set_derivation_bounds
+        max_length = None
+        if self.max_depth is not None or self.max_lengths is not None:
+            skeleton = None
+            max_length = self._draw_max_length(grammar, rng)
+            nodes = self._derive_bounded(grammar, rng, max_length, roots)
+        elif self.skeleton_depth is None:
+            skeleton = None
+            nodes = self._derive(grammar, rng, roots)
+        else:
+            skeletons = grammar.skeletons(self.skeleton_depth)
+            skeleton = skeletons.sample(rng)
+            nodes = self._derive_skeleton(grammar, skeleton, rng, roots)
+        if profile is not None:
+            profile.lap("derivation")
+            profile.nodes += len(nodes)
+
+        # REPLACE THE TERMINAL POSs WITH WORDS GENERATED ACCORDING TO THE ZIPFIAN DISTRIBUTIAN
+        # The links and slots of a skeleton can be used unless a paradigm adds properties they depend on
+        paradigm_properties = 0
+        for node in nodes:
+            paradigm_properties |= self._choose_word(grammar, node, required_words, sampling_method, zipf_skew, rng)
+        if profile is not None:
+            profile.lap("lexical")
+
+        retries = self.retry_budget
+        while True:
+            # Agreement changes the features of the words, so a retry starts again from these
+            if retries:
+                lexical_features = [node.features for node in nodes]
+            try:
+                # ADD AGREEMENT PROPERTIES, NOT YET INFLECTING
+                if (skeleton is not None and skeleton.is_complete
+                        and not paradigm_properties & skeletons.agreement_properties):
+                    self._agree_skeleton(grammar, skeleton, nodes)
+                else:
+                    self._agree(grammar, nodes)
+                if profile is not None:
+                    profile.lap("agreement")
+
+                # MAKE EACH WORD HAVE INFLECTIONS
+                # The compiled inflection tables turn each inflection into a lookup
+                # With a skeleton, a word only goes through its slots, unless its paradigm or agreement triggered
+                #   more tables
+                inflected_words = []
+                for position, node in enumerate(nodes):
+                    inflection_tables = grammar.inflection_tables
+                    if skeleton is not None and skeleton.is_complete and not ((node.features
+                                                                               & ~skeleton.features[position])
+                                                                              & skeletons.inflection_triggers):
+                        inflection_tables = skeleton.slots[position]
+                    try:
+                        inflected_words.append(_inflect_lexeme(node.lexeme, node.features, inflection_tables,
+                                                               grammar.environment_set, node.environment_mask))
+                    except GenerationError as error:
+                        error.position = position
+                        error.phrase = node.phrases[-1] if node.phrases else None
+                        raise
+                if profile is not None:
+                    profile.lap("inflection")
+                return " ".join(inflected_words), nodes
+
+            # LOCAL RETRIES
+            # Instead of throwing the sentence away, we draw the innermost phrase of the word the error is about again,
+            #   or the word itself if it isn't in a phrase
+            except GenerationError as error:
+                if not retries:
+                    raise
+                retries -= 1
+                if stats is not None:
+                    stats.record_retry(error)
+                for node, features in zip(nodes, lexical_features):
+                    node.features = features
+                if error.phrase in roots:
+                    next_phrase = 1 + max((phrase for node in nodes for phrase in node.phrases), default=-1)
+                    self._resample_phrase(grammar, nodes, roots, error.phrase, next_phrase, required_words,
+                                          sampling_method, zipf_skew, rng, max_length)
+                elif error.position is not None:
+                    node = nodes[error.position]
+                    node.features = node.properties
+                    self._choose_word(grammar, node, required_words, sampling_method, zipf_skew, rng)
+                else:
+                    raise
+                if profile is not None:
+                    profile.lap("retry")
+                    profile.nodes += len(nodes)
+                # The sentence doesn't match its skeleton anymore
+                skeleton = None
+
+    # Choose the word of a Node from the lexicon, or from required_words, and add its pos and paradigm to its features
+    # Returns the properties of the paradigm
+    def _choose_word(self, grammar, node, required_words, sampling_method, zipf_skew, rng):
+        # Get the terminal part of speech (pos) of the word
+        pos = node.pos
+        # Generate a word according to Zipf's distribution
+        # If there are no word which we are required to use, then we're good!
+        # If there are required words but the part of speech is not in required words, we get a word according
+        #   to the distribution we set earlier
+        if required_words is None or pos not in required_words:
+            # At this point we've checked and know that sampling_method is a valid choice
+            # Draw a word randomly according to the distribution we selected
+            if sampling_method == 'zipfian':
+                # Draw the index from Zipf's distribution truncated to the words of this pos
+                index = self._zipf_sampler(pos, zipf_skew).sample(rng)
+            # Draw a word uniformly
+            elif sampling_method == 'uniform':
+                index = rng.randrange(len(self.words[pos]))
+            word, paradigm = self.words[pos][index]
+            node.environment_mask = self._environment_masks(grammar, pos)[index]
+        # If we want to generate words from a list of words, then we draw uniformly from that set
+        else:
+            # Get the words at random from the list
+            word, paradigm = rng.choice(required_words[pos])
+            node.environment_mask = None
+        node.lexeme = word
+        # We also make the part of speech and the existing paradigm a new feature
+        # If an entry has more than one property we mark them with . boundaries
+        paradigm_properties = grammar.features.split_bits(paradigm)
+        node.features |= grammar.features.intern(pos) | paradigm_properties
+        return paradigm_properties
+
+    # Try to generate num_sentences sentences with a compiled grammar, drawing from the RandomSource rng
+    # Returns the sentences, their annotations (None if annotations is False) and a GenerationStats, which is a
+    #   GenerationProfile if profile is True
+    # Sentences that raise an exception are left out if regenerate_exception_sentences is True, and raise an error
+    #   otherwise. The annotations of sentences that annotation_random doesn't sample are None
+    def _generate_batch(self, grammar, num_sentences, required_words, sampling_method, regenerate_exception_sentences,
+                        zipf_skew, annotations, annotation_sample, annotation_random, rng, profile=False):
+        sentences = []
+        agreed_lexeme_sequences = [] if annotations else None
+        # We also want to keep track of the sentences thrown away and what threw them away
+        stats = GenerationProfile() if profile else GenerationStats()
+        profile = stats if profile else None
+        start = perf_counter()
+        for _ in range(num_sentences):
+            # If the code raises an exception, we stop if regenerate_exception_sentences is true
+            try:
+                sentence, nodes = self._generate_sentence(grammar, required_words, sampling_method, zipf_skew, rng,
+                                                          stats, profile)
+                # We only add the final sentence, and the properties of its words if we want them for debugging
+                sentences.append(sentence)
+                if profile is not None:
+                    profile.lengths[len(nodes)] = profile.lengths.get(len(nodes), 0) + 1
+                if annotations:
+                    # Sentences that aren't sampled keep their place in the annotations with None
+                    if annotation_sample == 1 or annotation_random.random() < annotation_sample:
+                        agreed_lexeme_sequences.append([node.annotation(grammar.features) for node in nodes])
+                    else:
+                        agreed_lexeme_sequences.append(None)
+            # We always catch exceptions
+            # Only the code and rule of the error are kept, its message is never put together
+            except Exception as error:
+                # If we want to regenerate, then we keep track of the sentences we regenerated
+                if regenerate_exception_sentences:
+                    stats.record_failure(error)
+                    if profile is not None:
+                        profile.lap("failed")
+                # Otherwise, we raise an error
+                else:
+                    raise Exception('Error raised during sentence generation. Solve above.')
+        stats.sentences = len(sentences)
+        if profile is not None:
+            profile.elapsed = perf_counter() - start
+        return sentences, agreed_lexeme_sequences, stats
+
+    # Check the arguments that generate_sentences and its streaming and sharded versions share
+    def _check_generation_arguments(self, num_sentences, sampling_method, annotation_sample):
+        # Make sure that sampling_method is 'zipfian' or 'uniform'
+        if sampling_method not in ['zipfian', 'uniform']:
+            raise ValueError(f'Sampling method {sampling_method} illegal.')
+        # Make sure that num_sentences is a strictly positive integer
+        assert type(num_sentences) is int and num_sentences > 0
+        assert 0 <= annotation_sample <= 1
+
+    # Generate sentences according to a certain distribution, one batch at a time
+    # This takes the same arguments as generate_sentences, and yields lists of the sentences generated from each
+    #   batch_size tries. If annotations is True, it yields (sentences, agreed_lexeme_sequences) pairs instead
+    # annotation_sample and annotation_seed work like they do for generate_sentences
+    # Only one batch is kept in memory at a time, so the number of sentences isn't bounded by memory
+    # The sentences are the same as generate_sentences gives with the same random state, in the same order
+    # stats is a GenerationStats that the counts of each batch are added to, if it isn't None. If it's a
+    #   GenerationProfile, the stages of generation are profiled too
+    def iter_sentences(self, num_sentences, required_words=None, sampling_method='zipfian',
+                       regenerate_exception_sentences=False, zipf_skew=1.2, batch_size=1000, annotations=False,
+                       annotation_sample=1.0, annotation_seed=0, rng=None, stats=None):
+        self._check_generation_arguments(num_sentences, sampling_method, annotation_sample)
+        assert type(batch_size) is int and batch_size > 0
+
+        # Compile the grammar, if it changed since it was last compiled
+        grammar = self.compile()
+        self._check_derivation_bounds(grammar)
+        self._prepare_skeletons(grammar)
+        rng = self.rng if rng is None else random_source(rng)
+
+        # Annotations are sampled with their own random number generator, so sampling doesn't change the sentences
+        annotation_random = random.Random(annotation_seed)
+        total_stats = GenerationStats()
+        profile = isinstance(stats, GenerationProfile)
+        with tqdm(total=num_sentences) as progress:
+            for start in range(0, num_sentences, batch_size):
+                batch_num_sentences = min(batch_size, num_sentences - start)
+                sentences, agreed_lexeme_sequences, batch_stats = self._generate_batch(
+                    grammar, batch_num_sentences, required_words, sampling_method, regenerate_exception_sentences,
+                    zipf_skew, annotations, annotation_sample, annotation_random, rng, profile)
+                progress.update(batch_num_sentences)
+                total_stats.update(batch_stats)
+                if stats is not None:
+                    stats.update(batch_stats)
+                # Hand over the batch, if it has anything in it
+                if sentences:
+                    yield (sentences, agreed_lexeme_sequences) if annotations else sentences
+        # When we finish generating the number of sentences we want, then we print the number of regenerations if wanted
+        if regenerate_exception_sentences:
+            print(f"When generating {num_sentences}, {total_stats.regenerated} were regenerated.")
+
+    # Generate sentences until they have num_tokens tokens, one batch at a time
+    # count_tokens counts the tokens of a list of sentences, returning the count of each one, e.g. count_words (the
+    #   default) or a function from tokenizer_counter. The sentences stop at the first one that reaches num_tokens
+    # This takes the same arguments as iter_sentences otherwise, and yields the same batches, except that there is no
+    #   number of sentences. The sentences are the same as the first ones iter_sentences gives with the same random
+    #   state. The tokens are counted as each batch is made, and the progress bar shows them
+    def iter_sentences_by_tokens(self, num_tokens, count_tokens=None, required_words=None, sampling_method='zipfian',
+                                 regenerate_exception_sentences=False, zipf_skew=1.2, batch_size=1000,
+                                 annotations=False, annotation_sample=1.0, annotation_seed=0, rng=None, stats=None):
+        self._check_generation_arguments(num_tokens, sampling_method, annotation_sample)
+        assert type(batch_size) is int and batch_size > 0
+        if count_tokens is None:
+            count_tokens = count_words
+
+        # Compile the grammar, if it changed since it was last compiled
+        grammar = self.compile()
+        self._check_derivation_bounds(grammar)
+        self._prepare_skeletons(grammar)
+        rng = self.rng if rng is None else random_source(rng)
+
+        annotation_random = random.Random(annotation_seed)
+        total_stats = GenerationStats()
+        profile = isinstance(stats, GenerationProfile)
+        generated_tokens = 0
+        with tqdm(total=num_tokens, unit="tokens") as progress:
+            while generated_tokens < num_tokens:
+                sentences, agreed_lexeme_sequences, batch_stats = self._generate_batch(
+                    grammar, batch_size, required_words, sampling_method, regenerate_exception_sentences,
+                    zipf_skew, annotations, annotation_sample, annotation_random, rng, profile)
+                # If every sentence fails, we would never get to num_tokens
+                if not sentences:
+                    raise ValueError(f"None of the {batch_size} sentences of a batch could be generated.")
+                counts = count_tokens(sentences)
+                # Cut the batch at the sentence that reaches num_tokens
+                if generated_tokens + sum(counts) >= num_tokens:
+                    for num_sentences, count in enumerate(counts, 1):
+                        generated_tokens += count
+                        if generated_tokens >= num_tokens:
+                            break
+                    sentences = sentences[:num_sentences]
+                    if annotations:
+                        agreed_lexeme_sequences = agreed_lexeme_sequences[:num_sentences]
+                    batch_stats.sentences = num_sentences
+                    progress.update(num_tokens - progress.n)
+                else:
+                    generated_tokens += sum(counts)
+                    progress.update(sum(counts))
+                total_stats.update(batch_stats)
+                if stats is not None:
+                    stats.update(batch_stats)
+                progress.set_postfix(sentences=total_stats.sentences)
+                yield (sentences, agreed_lexeme_sequences) if annotations else sentences
+        # When we finish generating the number of tokens we want, then we print the number of regenerations if wanted
+        if regenerate_exception_sentences:
+            print(f"When generating {total_stats.sentences} sentences with {generated_tokens} tokens, "
+                  f"{total_stats.regenerated} were regenerated.")
+
+    # generate_sentences with the sentences generated until they have num_tokens tokens, see iter_sentences_by_tokens
+    def generate_sentences_by_tokens(self, num_tokens, count_tokens=None, required_words=None,
+                                     sampling_method='zipfian', regenerate_exception_sentences=False, zipf_skew=1.2,
+                                     output='both', annotation_sample=1.0, annotation_seed=0, rng=None, stats=None):
+        _check_output(output)
+        return _collect_sentences(self.iter_sentences_by_tokens(num_tokens, count_tokens, required_words,
+                                                                sampling_method, regenerate_exception_sentences,
+                                                                zipf_skew, annotations=output != 'sentences',
+                                                                annotation_sample=annotation_sample,
+                                                                annotation_seed=annotation_seed, rng=rng,
+                                                                stats=stats), output)
+
+    # Generate one shard of iter_sentence_shards, with random number generators of its own
+    # Returns the sentences, their annotations (or None) and a GenerationStats
+    def _generate_shard(self, shard_index, num_sentences, seed, required_words, sampling_method,
+                        regenerate_exception_sentences, zipf_skew, annotations, annotation_sample, annotation_seed,
+                        profile):
+        rng = random_source(np.random.SeedSequence(seed, spawn_key=(shard_index,)))
+        annotation_random = random.Random(int(np.random.SeedSequence(annotation_seed, spawn_key=(shard_index,))
+                                              .generate_state(1)[0]))
+        return self._generate_batch(self.compile(), num_sentences, required_words, sampling_method,
+                                    regenerate_exception_sentences, zipf_skew, annotations, annotation_sample,
+                                    annotation_random, rng, profile)
+
+    # Generate sentences in shards of shard_size tries, spread over num_workers processes
+    # Every shard draws from a numpy.random.Generator seeded from seed and its index, so the sentences only depend on
+    #   seed and shard_size. The number of workers and the random state of the language don't change them
+    # This takes the same arguments as iter_sentences, and yields the sentences of every shard in order, or
+    #   (sentences, agreed_lexeme_sequences) pairs if annotations is True
+    # The language is compiled once, and each worker gets a pickled copy of it when it starts
+    # num_workers=None uses every CPU. With a single worker the shards are generated in this process
+    # stats is a GenerationStats that the counts of each shard are added to, if it isn't None, like for iter_sentences
+    def iter_sentence_shards(self, num_sentences, seed, num_workers=None, shard_size=10000, required_words=None,
+                             sampling_method='zipfian', regenerate_exception_sentences=False, zipf_skew=1.2,
+                             annotations=False, annotation_sample=1.0, annotation_seed=0, stats=None):
+        self._check_generation_arguments(num_sentences, sampling_method, annotation_sample)
+        assert type(shard_size) is int and shard_size > 0
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+
+        # Compile the language and build the skeletons and samplers it needs before it's copied to the workers
+        grammar = self.compile()
+        self._check_derivation_bounds(grammar)
+        self._prepare_skeletons(grammar)
+        if sampling_method == 'zipfian':
+            for pos, words in self.words.items():
+                if words and (required_words is None or pos not in required_words):
+                    self._zipf_sampler(pos, zipf_skew)
+
+        # Every shard is (shard index, number of sentences), the other arguments are the same for all of them
+        shards = [(shard_index, min(shard_size, num_sentences - shard_index * shard_size))
+                  for shard_index in range(-(-num_sentences // shard_size))]
+        arguments = (seed, required_words, sampling_method, regenerate_exception_sentences, zipf_skew, annotations,
+                     annotation_sample, annotation_seed, isinstance(stats, GenerationProfile))
+        if num_workers == 1 or len(shards) == 1:
+            results = (self._generate_shard(*shard, *arguments) for shard in shards)
+        else:
+            pool = multiprocessing.Pool(min(num_workers, len(shards)), initializer=_initialize_shard_worker,
+                                        initargs=(self, arguments))
+            results = pool.imap(_generate_shard, shards)
+        total_stats = GenerationStats()
+        try:
+            for sentences, agreed_lexeme_sequences, shard_stats in tqdm(results, total=len(shards)):
+                total_stats.update(shard_stats)
+                if stats is not None:
+                    stats.update(shard_stats)
+                yield (sentences, agreed_lexeme_sequences) if annotations else sentences
+        finally:
+            if num_workers != 1 and len(shards) != 1:
+                pool.terminate()
+        # When we finish generating the number of sentences we want, then we print the number of regenerations if wanted
+        if regenerate_exception_sentences:
+            print(f"When generating {num_sentences}, {total_stats.regenerated} were regenerated.")
+
     # Generate sentences according to a certain distribution
     # Required words is by default None.
     #   If you want to generate sentences with words from a specific set, you pass in a dictionary.
@@ -394,267 +2814,110 @@ class Language:
     #   All words drawn from required_words are drawn uniformly.
     # The default sampling method is Zipfian, set with 'zipfian' for sampling_method. You may also set this as uniform,
     #   setting sampling_method to 'uniform'. All other values will raise an error.
+    # zipf_skew is the skew parameter for Zipf's distribution. Find a naturalistic one
+    # Returns (sentences, agreed_lexeme_sequences), where the annotations are lists of [word, properties]
+    #   What's kept is set by output: 'both' keeps both, 'sentences' only keeps the sentences, and 'annotations' only
+    #   keeps the annotations. Whatever isn't kept is returned as None. All other values will raise an error.
+    #   Words are inflected either way, so the same sentences fail
+    # annotation_sample is the probability that the annotation of each sentence is kept. The annotations of the other
+    #   sentences are None, so agreed_lexeme_sequences stays in line with sentences. The sample is drawn with its own
+    #   random number generator seeded with annotation_seed, so it doesn't change the sentences
+    # rng overrides the random number generator of the language for this call, see the Language class
+    # stats is a GenerationStats that's filled in with the number of sentences regenerated and the rules and
+    #   paradigms whose errors made them get regenerated, or that local retries fixed. Pass one in to see which rules
+    #   cost the most sentences. Pass a GenerationProfile to also time the stages of generation
+    # This keeps every sentence in memory. Use iter_sentences to stream them instead
     def generate_sentences(self, num_sentences, required_words=None, sampling_method='zipfian',
-                           regenerate_exception_sentences=False):
-        # Make sure that sampling_method is 'zipfian' or 'uniform'
-        if sampling_method not in ['zipfian', 'uniform']:
-            raise ValueError(f'Sampling method {sampling_method} illegal.')
-        # Make sure that num_sentences is a strictly positive integer
-        assert type(num_sentences) is int and num_sentences > 0
+                           regenerate_exception_sentences=False, zipf_skew=1.2, output='both', annotation_sample=1.0,
+                           annotation_seed=0, rng=None, stats=None):
+        _check_output(output)
+        return _collect_sentences(self.iter_sentences(num_sentences, required_words, sampling_method,
+                                                      regenerate_exception_sentences, zipf_skew,
+                                                      annotations=output != 'sentences',
+                                                      annotation_sample=annotation_sample,
+                                                      annotation_seed=annotation_seed, rng=rng, stats=stats), output)
 
-        # Prepare the sentences we want
-        sentences = []
-        agreed_lexeme_sequences = []
-        # We also want to keep track of the number of exception sentences
-        exception_sentences = 0
-        for _ in tqdm(range(num_sentences)):
-            # If the code raises an exception, we stop if regenerate_exception_sentences is true
-            try:
-                # GENERATE THE TERMINAL POS STATES AND PROPERTIES
-                # We want the sentence to only contain terminal nodes, but we start with the start state
-                sentence = "S-"
-                # All terminals and properties are all lowercase.
-                # If the sentence contains uppercase letters, then we have not finished constructing it
-                while sentence.lower() != sentence:
-                    # Continually replace non-terminal nodes until the sentence doesn't change
-                    temp_sentence = ""
-                    for state in sentence.strip().split(" "):
-                        # Split this state from any properties it has
-                        raw_state, existing_properties = state.split("-")
-                        # Separate the existing properties into a list
-                        # The separated_existing_properties list will contain multiple elements if there is a "." in there
-                        # If there are no existing properties, then return an empty list
-                        separated_existing_properties = existing_properties.split(".")
-                        # We don't want a zero string property, so if the only element in the list is a zero string,
-                        #   then we make separated_existing_properties an empty list
-                        if separated_existing_properties == [""]:
-                            separated_existing_properties = []
-                        # If the raw states is a terminal part of speech, continue the loop
-                        if raw_state in self.words.keys():
-                            # We want to add the whole state
-                            temp_sentence += state + " "
-                            continue
-                        # If it's a generation rule, then we add words individually to the temp_sentence
-                        if raw_state in self.generation_rules:
-                            # Choose the next state(s) for this state
-                            # There will never be a new_property from a generation_rule
-                            next_states, new_property = choose_state(rule=self.generation_rules[raw_state],
-                                                                     is_generation=True)
-                            # For each next state, add the new property, but remove the property after *
-                            for next_state in next_states:
-                                # See if there is something to remove, if there isn't then there are no unwanted properties
-                                # If this throws an error, it means that there was more than 1 "*" in the next_state
-                                # If there is one unwanted property, then we split it on the asterisk
-                                if "*" in next_state:
-                                    true_next_state, unwanted_properties = next_state.split("*")
-                                # If there are no wanted properties, the next_state is the true_next_state
-                                else:
-                                    true_next_state, unwanted_properties = next_state, "__no_unwanted__"
-                                # Remove the property_to_be_removed for this next_state only, if applicable
-                                updated_existing_properties = deepcopy(separated_existing_properties)
-                                # For every unwanted property
-                                for unwanted_property in unwanted_properties.split("."):
-                                    # If the unwanted_property is in the existing_property, then we kick it
-                                    if unwanted_property in updated_existing_properties:
-                                        updated_existing_properties.remove(unwanted_property)
-                                    # If the unwanted property is a HASH, remove the whole hash value
-                                    if unwanted_property == "__hash__":
-                                        updated_existing_properties = [
-                                            prop for prop in updated_existing_properties if "__hash__" not in prop
-                                        ]
-                                # Add this next state, potentially without the unwanted_property, to the temp_sentence
-                                temp_sentence += (f'{true_next_state}-'
-                                                  f'{".".join(updated_existing_properties)} ')
-                        # If it's an unconditioned rule, we see if we want to add any properties
-                        elif raw_state in self.unconditioned_rules:
-                            # Choose the property for this state
-                            # There will only ever be one new next_state, but it will be wrapped in a list
-                            # There may be more than one new property though. These are period separated
-                            new_properties, next_states = choose_state(rule=self.unconditioned_rules[raw_state],
-                                                                       is_generation=False)
-                            for new_property in new_properties.split("."):
-                                # If the new_property is "__hash__", we want to add a hash value as the new property
-                                if new_property == "__hash__":
-                                    # We create a pseudorandom number and assign it to the next state of this object
-                                    # Remove the "0." though since that would mess everything up
-                                    # Some values will have "-" in the form of e- something, we want to remove that too
-                                    separated_existing_properties.append(
-                                        f"__hash__:{str(random.random())[2:].replace('-', '')}"
-                                    )
-                                # If the new property is not hash, then we just add it to the list of existing properties
-                                else:
-                                    # Add the new property to the existing properties
-                                    separated_existing_properties.append(new_property)
-                            # Add the new next_state with the new property to the temp_sentence
-                            temp_sentence += (f'{next_states[0]}-'
-                                              f'{".".join(separated_existing_properties)} ')
-                        # Sanity check: if we enter this loop, the state should be in either generation or unconditioned
-                        else:
-                            raise Exception(f"Invalid state for input {state} given raw_state {raw_state} \n" +
-                                            f"Make sure this is a key in generation or unconditioned rules.")
-                    # Update the value of sentence
-                    sentence = temp_sentence
-
-                # REPLACE THE TERMINAL POSs WITH WORDS GENERATED ACCORDING TO THE ZIPFIAN DISTRIBUTIAN
-                # Start with splitting the word into its pieces again
-                preagreement_words = []
-                for preagreement_word in sentence.strip().split(" "):
-                    # Split each word into the lexeme and its properties
-                    terminal, properties = preagreement_word.split("-")
-                    # Add the lexeme and a list of properties to the preagreement words
-                    preagreement_words.append([terminal, properties.split(".")])
-                preagreement_lexemes = []
-                for preagreement_word in preagreement_words:
-                    # Get the terminal part of speech (pos) and the properties of the word
-                    pos, properties = preagreement_word
-                    # Generate a word according to Zipf's distribution
-                    # If there are no word which we are required to use, then we're good!
-                    # If there are required words but the part of speech is not in required words, we get a word according
-                    #   to the distribution we set earlier
-                    if required_words is None or pos not in required_words:
-                        # At this point we've checked and know that sampling_method is a valid choice
-                        # Draw a word randomly according to the distribution we selected
-                        if sampling_method == 'zipfian':
-                            # Set the skew parameter for Zipf's distribution
-                            skew = 1.2  # Note: This parameter can be changed. Find a naturalistic one
-                            # There isn't a nice way to generate an index according to Zipf's law
-                            # The way we do it here is we generate a random index according to an unbounded distribution
-                            # If it is outside the range of our list, we generate another one
-                            # Otherwise, we use it
-                            index = -1
-                            while index == -1:
-                                # We generate an index, subtracting 1 since Zipf's starts from 1
-                                index = nprand.zipf(skew, 1)[0] - 1
-                                # If it's out of the range, we reset the index to 0
-                                if index >= len(self.words[pos]):
-                                    index = -1
-                            # If it is in the range, we exit our loop and get the word and paradigm
-                            word, paradigm = self.words[pos][index]
-                        # Draw a word uniformly
-                        elif sampling_method == 'uniform':
-                            word, paradigm = random.choice(self.words[pos])
-                    # If we want to generate words from a list of words, then we draw uniformly from that set
-                    else:
-                        # Get the words at random from the list
-                        word, paradigm = random.choice(required_words[pos])
-                    # Add the sentence to the word_sentence
-                    # We also make the part of speech and the existing paradigm a new feature
-                    # We use paradigm.split(".") since if an entry has more than one property we mark them with . boundaries
-                    preagreement_lexemes.append([word, properties + [pos] + paradigm.split(".")])
+    # generate_sentences with the sentences generated in shards over several processes, see iter_sentence_shards
+    # The result only depends on seed and shard_size, not on num_workers or the random state of the language
+    def generate_sentences_sharded(self, num_sentences, seed, num_workers=None, shard_size=10000, required_words=None,
+                                   sampling_method='zipfian', regenerate_exception_sentences=False, zipf_skew=1.2,
+                                   output='both', annotation_sample=1.0, annotation_seed=0, stats=None):
+        _check_output(output)
+        return _collect_sentences(self.iter_sentence_shards(num_sentences, seed, num_workers, shard_size,
+                                                            required_words, sampling_method,
+                                                            regenerate_exception_sentences, zipf_skew,
+                                                            annotations=output != 'sentences',
+                                                            annotation_sample=annotation_sample,
+                                                            annotation_seed=annotation_seed, stats=stats), output)
 
-                # ADD AGREEMENT PROPERTIES, NOT YET INFLECTING
-                # Now we iterate over every word to see if it must agree with any other words
-                # All the preagreement lexemes are stored as [word, properties]
-                agreed_words = []
-                # print(preagreement_lexemes)
-                for preagreement_word in preagreement_lexemes:
-                    # Check to see if there's a rule describing this word.
-                    # If there isn't, our work is done, so we add it to agreed_words and continue
-                    # If none of the properties of a word are in the agreement rules
-                    agreement_properties = list(set(preagreement_word[1]) & set(self.agreement_rules))
-                    if len(agreement_properties) == 0:
-                        agreed_words.append(preagreement_word)
-                        continue
-                    # For now, we can only handle one agreement. We might change this later
-                    assert len(agreement_properties) == 1
-                    # Get the rule for that terminal
-                    rule = self.agreement_rules[agreement_properties[0]]
-                    required_properties = set(rule[0])
-                    # If there is, we want to find THE word that triggers agreement
-                    words_triggering_agreement = []
-                    for other_word in preagreement_lexemes:
-                        # Make sure it has all the right properties
-                        # We do this by making sure that every required property is in other word's properties
-                        # For __hash__, we have to make sure that the hashes are the same for the agreement
-                        # E.g. det.:123 must agree with noun.:123.sg, but the way that's phrase is:
-                        #   "det": [["noun", "__hash__"], ["sg", "pl"]]
-                        # This is problematic since the noun isn't marked with "__hash__" as a property
-                        # What we need to do is:
-                        # for each property in the other word's properties
-                        #   if it's a hash property
-                        #       # Make sure the hashes are the same
-                        #   otherwise, check to see if it's in the required properties
-                        #   if the property (hash or otherwise) is not found, then we continue. This word doesn't agree
-                        #   otherwise, we add it to the words triggering agreement. There ultimately should only be one
-                        # We first start by assuming that the word has all the required properties
-                        all_required_properties_met = True
-                        # We iterate over all the properties in the rule to ensure they are in the other word:
-                        for required_property in required_properties:
-                            # If it's a hash property, we handle it differently
-                            if required_property == "__hash__":
-                                # We want to make sure that the hash values are the same
-                                # Firstly, find all the hash-like properties in this word and the other word
-                                this_word_hash = [prop for prop in preagreement_word[1] if ":" in prop]
-                                other_word_hash = [prop for prop in other_word[1] if ":" in prop]
-                                # Every hash in this word must also be in the other word
-                                # The reason this is the same (and not they need to full overlap) is as follows:
-                                # - This word and other word come from the same state
-                                # - Other word is the head, and may take on other hashes
-                                # - This word won't take on other hashes (e.g. NP --> det NOM)
-                                # Therefore, we just need to make sure that the overlap is the same as this word's
-                                if set(this_word_hash) & set(other_word_hash) != set(this_word_hash):
-                                    all_required_properties_met = False
-                            # If it's a normal property, we just want to make sure it's in the other word's property list
-                            else:
-                                # If the required properties are missing, then we set all_required_properties_met to false
-                                if required_property not in other_word[1]:
-                                    all_required_properties_met = False
-                            # If any property is not found, this isn't the word for us
-                            if not all_required_properties_met:
-                                break
-                        # If any property is not found, this isn't the word for us:
-                        if not all_required_properties_met:
-                            continue
-                        # If it does have all the right properties, add it to the list of words triggering agreement
-                        words_triggering_agreement.append(other_word)
-                    # Now we make sure there's EXACTLY ONE word triggering agreement
-                    if len(words_triggering_agreement) != 1:
-                        raise Exception(f"{len(words_triggering_agreement)} words triggered agreement for "
-                                        f"{preagreement_word}. These words are {words_triggering_agreement}. "
-                                        f"The rule that triggered it is {rule}. "
-                                        f"Check rules. \n"
-                                        f"Preagreement lexemes: {preagreement_lexemes}")
-                    # Perfect! Now that we found the word that agrees with our preagreement word, we find the properties
-                    # We want to check that the word triggering agreement has one of each property in each set
-                    word_triggering_agreement = words_triggering_agreement[0]
-                    # For every property that our preagreement word seeks, we look to see if trigger word has it
-                    new_properties = []
-                    # For every feature in that the preagreement word looks for
-                    for sought_feature in rule[1]:
-                        # Make sure that the intersection of the sought properties with the word triggering agreement is one
-                        property_intersection = list(set(sought_feature) & set(word_triggering_agreement[1]))
-                        # If there isn't exactly 1, then raise an error
-                        if len(property_intersection) != 1:
-                            raise Exception(f"Incorrect number of properties found for {preagreement_word}. \n"
-                                            f"Sought feature: {sought_feature}. \n"
-                                            f"Word triggering agreement: {word_triggering_agreement}")
-                        # If there is exactly one feature, then we add it to the new properties of the preagreement word
-                        new_properties.append(property_intersection[0])
-                    # Now we have found all the new properties of the preagreement word!
-                    # All that is left is to join the old and new properties, and add this word to our agreed word list
-                    agreed_words.append([preagreement_word[0], preagreement_word[1] + new_properties])
-                agreed_lexeme_sequences.append(agreed_words)
+    # The set of all the forms in the lexicon
+    # It can be None, e.g. for a language from a snapshot, in which case it's made from the words when it's needed
+    @property
+    def word_set(self):
+        if self._word_set is None:
+            self._word_set = {word for words in self.words.values() for word, _ in words}
+        return self._word_set
 
-                # MAKE EACH WORD HAVE INFLECTIONS
-                # We get only the first element of the output since we are only making one sentence
-                inflected_words = inflect([agreed_words], self.inflection_paradigms, self.phonemes)[0]
+    @word_set.setter
+    def word_set(self, word_set):
+        self._word_set = word_set
 
-                # FINALLY, GIVE THE SURFACE FORM
-                # We only add the final sentence, not the properties, but we keep them along until the end for debugging
-                sentences.append(inflected_words)
-            # We always catch exceptions
-            except Exception:
-                # If we want to regenerate, then we keep track of the number of sentences we regenerated
-                if regenerate_exception_sentences:
-                    exception_sentences += 1
-                # Otherwise, we raise an error
-                else:
-                    raise Exception('Error raised during sentence generation. Solve above.')
-        # When we finish generating the number of sentences we want, then we print the number of regenerations if wanted
-        if regenerate_exception_sentences:
-            print(f"When generating {num_sentences}, {exception_sentences} were regenerated.")
-        # Finally, we exit the loop and return the list of sentences
-        return sentences, agreed_lexeme_sequences
+    # Save the language as a snapshot in a directory, which load_snapshot loads
+    # A snapshot has the rules and the compiled grammar in language.pickle, and the lexicon as arrays in .npy files
+    #   that load_snapshot maps into memory (see _MappedLexicon). The environment masks of the words are in the lexicon
+    #   rather than the grammar
+    def dump_snapshot(self, directory_path):
+        grammar = self.compile()
+        os.makedirs(directory_path, exist_ok=True)
+        # Lay the lexicon out one pos after the other, with every pos having its own list of paradigms
+        encoded_forms = []
+        paradigm_ids = []
+        environment_masks = []
+        lexicon = {}
+        for pos, words in self.words.items():
+            paradigms = {}
+            for word, paradigm in words:
+                encoded_forms.append(word.encode())
+                paradigm_ids.append(paradigms.setdefault(paradigm, len(paradigms)))
+            environment_masks += self._environment_masks(grammar, pos)
+            lexicon[pos] = (len(encoded_forms) - len(words), len(encoded_forms), list(paradigms))
+        form_offsets = np.zeros(len(encoded_forms) + 1, dtype=np.int64)
+        np.cumsum([len(form) for form in encoded_forms], out=form_offsets[1:])
+        # Every environment takes 2 bits of a mask, so masks of more than 32 environments take more than one column
+        num_columns = max(1, -(-2 * len(grammar.environment_set.environments) // 64))
+        environment_masks = np.array(environment_masks, dtype=object)
+        arrays = {
+            "forms": np.frombuffer(b"".join(encoded_forms), dtype=np.uint8),
+            "form_offsets": form_offsets,
+            "paradigm_ids": np.array(paradigm_ids, dtype=np.int32),
+            "environment_masks": np.stack([((environment_masks >> (64 * i)) & ((1 << 64) - 1)).astype(np.uint64)
+                                           for i in range(num_columns)], axis=1),
+        }
+        # Files are replaced rather than overwritten, so processes that have the old ones mapped can keep using them
+        for name, array in arrays.items():
+            filepath = os.path.join(directory_path, f"{name}.npy")
+            with open(filepath + ".tmp", "wb") as file:
+                np.save(file, array)
+            os.replace(filepath + ".tmp", filepath)
+        # The environment masks are in the lexicon, so the grammar is pickled without them
+        grammar = copy(grammar)
+        grammar.environment_masks = {}
+        data = {
+            "version": _SNAPSHOT_VERSION,
+            "phonemes": self.phonemes,
+            "syllables": self.syllables,
+            "syllable_lambda": self.syllable_lambda,
+            "generation_rules": self.generation_rules,
+            "unconditioned_rules": self.unconditioned_rules,
+            "agreement_rules": self.agreement_rules,
+            "inflection_paradigms": self.inflection_paradigms,
+            "lexicon": lexicon,
+            "grammar": grammar,
+        }
+        with open(os.path.join(directory_path, "language.pickle"), "wb") as file:
+            pickle.dump(data, file, protocol=pickle.HIGHEST_PROTOCOL)
+        # Languages loaded from the snapshot before keep their old files, but new ones should map the new files
+        _MAPPED_LEXICONS.pop(os.path.abspath(directory_path), None)
 
     # Save the language in a given file
     def dump_language(self, directory_path):
@@ -670,7 +2933,7 @@ class Language:
                 "generation_rules": self.generation_rules,
                 "unconditioned_rules": self.unconditioned_rules,
                 "agreement_rules": self.agreement_rules,
-                "words": self.words,
+                "words": {pos: list(words) for pos, words in self.words.items()},
                 # Word_set must first be converted to a list
                 "word_set": list(sorted(self.word_set))
             }